@@ -0,0 +1,96 @@
+'''
+Description:
+- One-off backfill of search keywords [see main.buildSearchKeywords] for listings written before search by words existed.
+  Such listings have no keywords field, so /get-connections?search= never finds them until this is run.
+- Goes over both UnapprovedListings and ApprovedListings page by page, and only writes listings whose keywords are missing or out of date,
+  so running it again only costs reads.
+- Only the keywords field is updated, with firestore BulkWriter, which throttles and retries writes. updatedAt is not changed, as keywords are
+  never sent to frontend, so frontends syncing only changes don't get every listing again.
+- Uses the real Firebase project configured in ./config [see README]. Safe to run while the backend is serving.
+
+Run using: python backfillSearchKeywords.py [--page-size 500]
+'''
+import argparse
+import threading
+
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, BulkRetry
+
+import main
+
+#status code of a failed write for a document that doesn't exist anymore, e.g. an unapproved listing approved while backfilling
+NOT_FOUND_CODE = 5
+
+'''
+description: sets search keywords of every listing of a collection that doesn't have them or has out of date ones
+takes
+    collectionRef: firestore collection of listings
+    pageSize:int number of listings read and written at a time
+returns dict with counts 'read', 'updated', 'skipped' [listing removed while backfilling] and 'failed'
+'''
+def backfillCollection(collectionRef, pageSize:int) -> dict:
+    counts = {'read': 0, 'updated': 0, 'skipped': 0, 'failed': 0}
+    countsLock = threading.Lock()#BulkWriter calls back from its own threads
+
+    def onWriteResult(reference, writeResult, bulkWriter):
+        with countsLock:
+            counts['updated'] += 1
+
+    #retries failed writes with exponential backoff, except for listings that are gone [already have keywords if they were approved]
+    def onWriteError(failure, bulkWriter) -> bool:
+        if(failure.code == NOT_FOUND_CODE):
+            with countsLock:
+                counts['skipped'] += 1
+            return False
+
+        shouldRetry = failure.attempts < main.BULK_CREATE_MAX_ATTEMPTS
+        if(not shouldRetry):
+            print(f'An error occurred while backfilling keywords of listing {failure.operation.reference.id} : {failure.message}')
+            with countsLock:
+                counts['failed'] += 1
+        return shouldRetry
+
+    bulkWriter = main.db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=main.BULK_CREATE_INITIAL_OPS_PER_SECOND,
+        max_ops_per_second=main.BULK_CREATE_MAX_OPS_PER_SECOND,
+        retry=BulkRetry.exponential,
+    ))
+    bulkWriter.on_write_result(onWriteResult)
+    bulkWriter.on_write_error(onWriteError)
+
+    try:
+        afterId = None
+        while(True):
+            #only the fields keywords are built from, ordered by id so pages resume where the last one ended
+            pageQuery = collectionRef.select(['title', 'description', 'keywords']).order_by(main.DOCUMENT_ID_FIELD).limit(pageSize)
+            if(afterId != None):
+                pageQuery = pageQuery.start_after({main.DOCUMENT_ID_FIELD: afterId})
+            docs = list(pageQuery.stream(timeout=main.FIRESTORE_QUERY_TIMEOUT))
+
+            for doc in docs:
+                listingDocument = doc.to_dict()
+                keywords = main.buildSearchKeywords(listingDocument)
+                if(listingDocument.get('keywords') != keywords):
+                    bulkWriter.update(doc.reference, {'keywords': keywords})#fails if the listing was removed meanwhile, instead of creating it again
+            counts['read'] += len(docs)
+
+            bulkWriter.flush()#one page waiting in memory at a time
+            if(len(docs) < pageSize):
+                return counts
+            afterId = docs[-1].id
+    finally:
+        bulkWriter.close()
+
+def runBackfill():
+    parser = argparse.ArgumentParser(description='Sets search keywords of listings written before search by words existed')
+    parser.add_argument('--page-size', type=int, default=500, help='listings read and written at a time')
+    args = parser.parse_args()
+
+    if(not main.ensureServicesInitialized()):
+        raise SystemExit('Could not start firebase, see the error above')
+
+    for collectionName, collectionRef in (('UnapprovedListings', main.unapprovedListingsRef), ('ApprovedListings', main.approvedListingsRef)):
+        counts = backfillCollection(collectionRef, args.page_size)
+        print(f"{collectionName}: read {counts['read']}, updated {counts['updated']}, skipped {counts['skipped']} [removed meanwhile], failed {counts['failed']}")
+
+if __name__ == '__main__':
+    runBackfill()
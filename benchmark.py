@@ -0,0 +1,158 @@
+'''
+Description:
+- Offline benchmark of the backend, using the in-memory stand-ins of Firebase [see fakeFirebase.useFakeServices].
+- Seeds listings, then drives /get-connections, /create-connection and /approve-connection at the given concurrency,
+  and reports requests per second and p50/p99 latency of each.
+- Requests go through flask's test client, so what is measured is the backend itself, without a web server or network in between.
+
+Run using: python benchmark.py --listings 10000 --concurrency 8 --requests 500
+'''
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fakeFirebase
+import main
+
+#uids used for the benchmark users
+ADMIN_UID = 'benchmark-admin'
+USER_UID = 'benchmark-user'
+
+#listings created for seeding and by create-connection, spread over some locations and both types
+LOCATIONS = ('Toronto', 'Mississauga', 'Brampton', 'Oakville', 'Hamilton')
+
+'''
+description: builds form data of a listing, as sent by frontend to create-connection
+takes index:int number of the listing, used for making each one different
+returns dict form data
+'''
+def buildListingForm(index:int) -> dict:
+    return {
+        'title': f'Community group {index}',
+        'description': f'Group number {index} for people who want to meet others nearby and share events',
+        'type': main.LISTING_TYPES[index % len(main.LISTING_TYPES)],
+        'link': f'https://chat.whatsapp.com/benchmark{index}',
+        'location': LOCATIONS[index % len(LOCATIONS)],
+    }
+
+'''
+description: fills the fake firestore with approved and unapproved listings, using batched writes
+takes
+    firestoreClient: fakeFirebase.FakeFirestore
+    approvedCount:int number of approved listings
+    unapprovedCount:int number of unapproved listings [waiting for approval], by the benchmark user
+returns list[str] ids of unapproved listings
+'''
+def seedListings(firestoreClient, approvedCount:int, unapprovedCount:int) -> list:
+    unapprovedIds = []
+    batch = firestoreClient.batch()
+
+    for index in range(approvedCount + unapprovedCount):
+        listingDocument = main.buildListingDocument(buildListingForm(index), USER_UID)
+        if(index < approvedCount):
+            batch.set(main.approvedListingsRef.document(), listingDocument)
+        else:
+            listingRef = main.unapprovedListingsRef.document()
+            unapprovedIds.append(listingRef.id)
+            batch.set(listingRef, listingDocument)
+
+        if(len(batch.writes) >= 500):
+            batch.commit()
+            batch = firestoreClient.batch()
+    batch.commit()
+
+    return unapprovedIds
+
+'''
+description: sends requests of one scenario at the given concurrency, and measures each of them
+takes
+    sendRequest: callable(client, index) -> response. Called once per request, with a test client of the calling thread
+    requestCount:int number of requests
+    concurrency:int number of requests in flight at the same time
+returns dict with 'latencies': list[float] seconds, 'errors': int, 'durationSeconds': float
+'''
+def runScenario(sendRequest, requestCount:int, concurrency:int) -> dict:
+    threadState = threading.local()#each thread has its own test client
+
+    def timedRequest(index:int):
+        if(not hasattr(threadState, 'client')):
+            threadState.client = main.app.test_client()
+
+        startedAt = time.perf_counter()
+        response = sendRequest(threadState.client, index)
+        latency = time.perf_counter() - startedAt
+
+        body = response.get_json(silent=True)
+        isError = response.status_code != 200 or type(body) is not dict or body.get('status') != 200
+        return latency, isError
+
+    startedAt = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timedRequest, range(requestCount)))
+    durationSeconds = time.perf_counter() - startedAt
+
+    return {
+        'latencies': [latency for latency, _ in results],
+        'errors': sum(1 for _, isError in results if isError),
+        'durationSeconds': durationSeconds,
+    }
+
+'''
+description: gets a percentile of measured latencies
+takes latencies:list[float], percentile:float between 0 and 100
+returns float latency
+'''
+def percentileOf(latencies:list, percentile:float) -> float:
+    sortedLatencies = sorted(latencies)
+    index = min(len(sortedLatencies) - 1, max(0, round(percentile / 100 * len(sortedLatencies)) - 1))
+    return sortedLatencies[index]
+
+'''
+description: prints results of a scenario as one row of the report
+takes name:str scenario name, result:dict as returned by runScenario
+returns nothing
+'''
+def printResult(name:str, result:dict):
+    latencies = result['latencies']
+    requestsPerSecond = len(latencies) / result['durationSeconds']
+    print(f"{name:<28} {len(latencies):>8} {result['errors']:>7} {requestsPerSecond:>10.1f} {percentileOf(latencies, 50) * 1000:>9.2f} {percentileOf(latencies, 99) * 1000:>9.2f}")
+
+def runBenchmark():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the backend, using in-memory stand-ins of Firebase')
+    parser.add_argument('--listings', type=int, default=1000, help='approved listings seeded before the benchmark')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight at the same time')
+    parser.add_argument('--requests', type=int, default=200, help='requests sent per scenario')
+    parser.add_argument('--approved-view', action='store_true', help='answer approved listings from the in-memory copy [APPROVED_LISTINGS_VIEW]')
+    parser.add_argument('--scenarios', default='get-connections,get-connections-page,create-connection,approve-connection', help='comma separated scenarios to run')
+    args = parser.parse_args()
+
+    #stand-ins for firebase
+    firestoreClient, _ = fakeFirebase.useFakeServices(ADMIN_UID)
+
+    unapprovedIds = seedListings(firestoreClient, args.listings, args.requests)
+
+    if(args.approved_view):
+        main.APPROVED_LISTINGS_VIEW_ENABLED = True
+        main.startApprovedListingsView()
+        main.approvedListingsView['ready'].wait()
+
+    userHeaders = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(USER_UID)}'}
+    adminHeaders = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(ADMIN_UID)}'}
+
+    scenarios = {
+        'get-connections': lambda client, index: client.get('/get-connections', headers=userHeaders),
+        'get-connections-page': lambda client, index: client.get('/get-connections?limit=50', headers=userHeaders),
+        'create-connection': lambda client, index: client.post('/create-connection', data=buildListingForm(index), headers=userHeaders),
+        'approve-connection': lambda client, index: client.post('/approve-connection', data={'listingId': unapprovedIds[index]}, headers=adminHeaders),
+    }
+
+    print(f'listings: {args.listings}, concurrency: {args.concurrency}, requests per scenario: {args.requests}, approved view: {args.approved_view}')
+    print(f"{'scenario':<28} {'requests':>8} {'errors':>7} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for name in args.scenarios.split(','):
+        if(name not in scenarios):
+            parser.error(f'Unknown scenario {name}')
+        printResult(name, runScenario(scenarios[name], args.requests, args.concurrency))
+
+if __name__ == '__main__':
+    runBenchmark()
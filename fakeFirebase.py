@@ -0,0 +1,544 @@
+'''
+Description:
+- In-memory stand-ins for the Firestore client and Firebase authentication client used by main.py.
+- Lets the backend run without a Firebase project or network, e.g. for benchmark.py. Plug them in using main.configureServices.
+- Only the parts of the Firestore/auth APIs that main.py uses are implemented. Everything is kept in memory of this process and lost when it exits.
+'''
+from firebase_admin import firestore, auth
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from datetime import datetime, timedelta, timezone
+import copy
+import random
+import string
+import threading
+import time
+
+#special field path which orders documents by their document id
+DOCUMENT_ID_FIELD = '__name__'
+
+#prefix of fake auth tokens. A token is this prefix followed by the uid of the user
+FAKE_ID_TOKEN_PREFIX = 'fake-id-token:'
+
+'''
+description: creates a fake auth token for a user, as accepted by FakeAuthClient.verify_id_token
+takes uid:str user id
+returns token:str
+'''
+def fakeIdToken(uid:str) -> str:
+    return f'{FAKE_ID_TOKEN_PREFIX}{uid}'
+
+'''
+description: runs main.py against in-memory stand-ins of firestore and firebase authentication, so it needs no firebase project or network.
+Used by the tests and benchmark.py
+takes adminUid:str|None uid of the admin user, None keeps the one main.py has
+returns tuple of (FakeFirestore, FakeAuthClient) configured in main.py
+'''
+def useFakeServices(adminUid:str|None = None) -> tuple:
+    import main#imported here, as main.py itself doesn't need the stand-ins
+
+    firestoreClient = FakeFirestore()
+    authClient = FakeAuthClient()
+    main.configureServices(firestoreClient, authClient, authClient.sign_in_with_password)
+    if(adminUid != None):
+        main.ADMIN_TOKEN = adminUid
+
+    return firestoreClient, authClient
+
+'''
+description: in-memory stand-in for firestore client
+- writes are applied atomically under one lock, and every commit gets a later time than the previous one, like firestore commit times
+- snapshot listeners are called right after each commit that changes their collection, in the thread that committed
+'''
+class FakeFirestore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.collections = {}#collection name -> {document id -> {'data': dict, 'createTime': datetime, 'updateTime': datetime}}
+        self.listeners = {}#collection name -> list of callbacks
+        self.lastCommitTime = datetime.fromtimestamp(0, timezone.utc)
+
+    def collection(self, name:str):
+        return FakeCollectionReference(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self, options=None):
+        return FakeBulkWriter(self)
+
+    def write_option(self, last_update_time:datetime):
+        return FakeWriteOption(last_update_time)
+
+    '''
+    description: reads many documents at once
+    takes references: list of FakeDocumentReference
+    returns generator of FakeDocumentSnapshot, also for documents that don't exist [exists is False]
+    '''
+    def get_all(self, references, **kwargs):
+        with self.lock:
+            snapshots = [reference.get() for reference in references]
+
+        for snapshot in snapshots:
+            yield snapshot
+
+    '''
+    description: applies writes atomically. Either all writes are applied or none
+    takes writes: list of (operation:'create'|'set'|'update'|'delete', reference:FakeDocumentReference, data:dict|None, option:FakeWriteOption|None)
+    returns commit time:datetime
+    raises FakeConflictError if a document being created already exists, NotFound if a document being updated doesn't exist,
+        FailedPrecondition if a document's update time is not the one of its write option
+    '''
+    def commit(self, writes:list) -> datetime:
+        with self.lock:
+            for operation, reference, data, option in writes:
+                existing = self.collections.get(reference.collectionName, {}).get(reference.id)
+                if(operation == 'create' and existing != None):
+                    raise FakeConflictError(f'Document already exists: {reference.collectionName}/{reference.id}')
+                if(operation == 'update' and existing == None):
+                    raise NotFound(f'No document to update: {reference.collectionName}/{reference.id}')
+                if(option != None and (existing == None or existing['updateTime'] != option.last_update_time)):
+                    raise FailedPrecondition(f'Document changed since it was read: {reference.collectionName}/{reference.id}')
+
+            commitTime = max(datetime.now(timezone.utc), self.lastCommitTime + timedelta(microseconds=1))
+            self.lastCommitTime = commitTime
+
+            changedCollections = set()
+            for operation, reference, data, option in writes:
+                documents = self.collections.setdefault(reference.collectionName, {})
+                changedCollections.add(reference.collectionName)
+
+                if(operation == 'delete'):
+                    documents.pop(reference.id, None)
+                    continue
+
+                existing = documents.get(reference.id)
+                if(operation == 'update'):
+                    data = {**existing['data'], **data}#only the given fields change
+                documents[reference.id] = {
+                    'data': resolveServerTimestamps(data, commitTime),
+                    'createTime': commitTime if existing == None else existing['createTime'],
+                    'updateTime': commitTime,
+                }
+
+            notifications = []
+            for collectionName in changedCollections:
+                for callback in self.listeners.get(collectionName, []):
+                    notifications.append((callback, self.collection(collectionName).get()))
+
+        #outside the lock, so listeners can read again without waiting
+        for callback, snapshots in notifications:
+            callback(snapshots, [], commitTime)
+
+        return commitTime
+
+'''
+description: error raised when creating a document that already exists, like google.api_core.exceptions.Conflict
+'''
+class FakeConflictError(Exception):
+    pass
+
+'''
+description: replaces firestore.SERVER_TIMESTAMP values of a document with the commit time
+takes data:dict document data, commitTime:datetime
+returns dict copy of the document
+'''
+def resolveServerTimestamps(data:dict, commitTime:datetime) -> dict:
+    resolved = {}
+    for fieldName, value in data.items():
+        resolved[fieldName] = commitTime if value is firestore.SERVER_TIMESTAMP else copy.deepcopy(value)
+    return resolved
+
+'''
+description: in-memory stand-in for a firestore document snapshot
+'''
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data:dict|None, createTime:datetime|None, updateTime:datetime|None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = (data != None)
+        self.create_time = createTime
+        self.update_time = updateTime
+        self._data = data
+
+    def to_dict(self) -> dict|None:
+        return copy.deepcopy(self._data)
+
+    def get(self, fieldPath:str):
+        if(self._data == None or fieldPath not in self._data):
+            raise KeyError(fieldPath)
+        return copy.deepcopy(self._data[fieldPath])
+
+'''
+description: in-memory stand-in for a firestore document reference
+'''
+class FakeDocumentReference:
+    def __init__(self, firestoreClient:FakeFirestore, collectionName:str, documentId:str):
+        self.firestoreClient = firestoreClient
+        self.collectionName = collectionName
+        self.id = documentId
+        self.path = f'{collectionName}/{documentId}'
+
+    def get(self, **kwargs) -> FakeDocumentSnapshot:
+        with self.firestoreClient.lock:
+            stored = self.firestoreClient.collections.get(self.collectionName, {}).get(self.id)
+            if(stored == None):
+                return FakeDocumentSnapshot(self, None, None, None)
+            return FakeDocumentSnapshot(self, stored['data'], stored['createTime'], stored['updateTime'])
+
+    def create(self, data:dict, **kwargs):
+        self.firestoreClient.commit([('create', self, data, None)])
+
+    def set(self, data:dict, **kwargs):
+        self.firestoreClient.commit([('set', self, data, None)])
+
+    def delete(self, **kwargs):
+        self.firestoreClient.commit([('delete', self, None, None)])
+
+'''
+description: in-memory stand-in for a firestore query. Each method returns a new query, like firestore queries
+- supports where with ==, !=, <, <=, >, >=, in and array_contains, order_by, start_after, limit, select and count
+'''
+class FakeQuery:
+    def __init__(self, firestoreClient:FakeFirestore, collectionName:str, filters:tuple = (), orders:tuple = (), cursor:tuple|None = None, limitCount:int|None = None, fields:tuple|None = None):
+        self.firestoreClient = firestoreClient
+        self.collectionName = collectionName
+        self.filters = filters
+        self.orders = orders
+        self.cursor = cursor
+        self.limitCount = limitCount
+        self.fields = fields
+
+    def copyWith(self, **changes):
+        arguments = {
+            'filters': self.filters,
+            'orders': self.orders,
+            'cursor': self.cursor,
+            'limitCount': self.limitCount,
+            'fields': self.fields,
+        }
+        arguments.update(changes)
+        return FakeQuery(self.firestoreClient, self.collectionName, **arguments)
+
+    def where(self, fieldPath:str, operator:str, value):
+        return self.copyWith(filters=self.filters + ((fieldPath, operator, value),))
+
+    def order_by(self, fieldPath:str, direction:str = 'ASCENDING'):
+        return self.copyWith(orders=self.orders + ((fieldPath, direction == 'DESCENDING'),))
+
+    def start_after(self, values):
+        if(isinstance(values, FakeDocumentSnapshot)):
+            values = dict(values._data, **{DOCUMENT_ID_FIELD: values.id})
+
+        cursorValues = []
+        for fieldPath, isDescending in self.orders:
+            value = values[fieldPath]
+            if(fieldPath == DOCUMENT_ID_FIELD and isinstance(value, FakeDocumentReference)):
+                value = value.id
+            elif(fieldPath == DOCUMENT_ID_FIELD):
+                value = FakeCollectionReference(self.firestoreClient, self.collectionName).document(value).id#like firestore, fails for an id with /
+            cursorValues.append(value)
+
+        return self.copyWith(cursor=tuple(cursorValues))
+
+    def limit(self, count:int):
+        return self.copyWith(limitCount=count)
+
+    def select(self, fieldPaths):
+        return self.copyWith(fields=tuple(fieldPaths))
+
+    def count(self, alias:str|None = None):
+        return FakeAggregationQuery(self, alias or 'count')
+
+    def get(self, **kwargs) -> list:
+        return list(self.stream())
+
+    def stream(self, **kwargs):
+        with self.firestoreClient.lock:
+            documents = list(self.firestoreClient.collections.get(self.collectionName, {}).items())
+
+        #like firestore, documents without a field used in order_by are left out
+        matching = [(documentId, stored) for documentId, stored in documents if self.matches(stored['data'])
+                    and all(fieldPath == DOCUMENT_ID_FIELD or fieldPath in stored['data'] for fieldPath, _ in self.orders)]
+
+        #like firestore, results are ordered by the order_by fields, then by document id
+        orders = self.orders if any(fieldPath == DOCUMENT_ID_FIELD for fieldPath, _ in self.orders) else self.orders + ((DOCUMENT_ID_FIELD, False),)
+        for fieldPath, isDescending in reversed(orders):
+            matching.sort(key=lambda item: orderValue(item, fieldPath), reverse=isDescending)
+
+        if(self.cursor != None):
+            matching = [item for item in matching if self.isAfterCursor(item)]
+        if(self.limitCount != None):
+            matching = matching[:self.limitCount]
+
+        for documentId, stored in matching:
+            data = stored['data']
+            if(self.fields != None):
+                data = {fieldPath: data[fieldPath] for fieldPath in self.fields if fieldPath in data}
+            yield FakeDocumentSnapshot(FakeDocumentReference(self.firestoreClient, self.collectionName, documentId), data, stored['createTime'], stored['updateTime'])
+
+    def matches(self, data:dict) -> bool:
+        for fieldPath, operator, value in self.filters:
+            if(fieldPath not in data):
+                return False
+            fieldValue = data[fieldPath]
+
+            try:
+                if(operator == '==' and not fieldValue == value):
+                    return False
+                if(operator == '!=' and not fieldValue != value):
+                    return False
+                if(operator == '<' and not fieldValue < value):
+                    return False
+                if(operator == '<=' and not fieldValue <= value):
+                    return False
+                if(operator == '>' and not fieldValue > value):
+                    return False
+                if(operator == '>=' and not fieldValue >= value):
+                    return False
+                if(operator == 'in' and fieldValue not in value):
+                    return False
+                if(operator == 'array_contains' and (type(fieldValue) is not list or value not in fieldValue)):
+                    return False
+            except TypeError:
+                return False#values of different types never match, like in firestore
+
+        return True
+
+    def isAfterCursor(self, item) -> bool:
+        for (fieldPath, isDescending), cursorValue in zip(self.orders, self.cursor):
+            value = orderValue(item, fieldPath)
+            if(value == cursorValue):
+                continue
+            return (value < cursorValue) if isDescending else (value > cursorValue)
+
+        return False#same values as the cursor, so it is the cursor document itself
+
+'''
+description: gets the value a document is ordered by
+takes item: tuple of (document id, stored document), fieldPath:str
+returns value of the field, or document id for DOCUMENT_ID_FIELD
+'''
+def orderValue(item, fieldPath:str):
+    documentId, stored = item
+    if(fieldPath == DOCUMENT_ID_FIELD):
+        return documentId
+    return stored['data'].get(fieldPath)
+
+'''
+description: in-memory stand-in for a firestore collection reference
+'''
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, firestoreClient:FakeFirestore, name:str):
+        super().__init__(firestoreClient, name)
+        self.id = name
+
+    def document(self, documentId:str|None = None) -> FakeDocumentReference:
+        if(documentId == None):
+            #auto ID, same alphabet and length as firestore
+            documentId = ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+        elif('/' in documentId):
+            #like firestore, an id with / is a path to a document of a subcollection, which a collection's document can't have
+            raise ValueError(f'A document must have an even number of path elements: {self.id}/{documentId}')
+        return FakeDocumentReference(self.firestoreClient, self.id, documentId)
+
+    '''
+    description: listens to changes of the collection. Callback gets called right away with all documents, then after every change
+    takes callback: callable(docSnapshots, changes, readTime)
+    returns watch with unsubscribe()
+    '''
+    def on_snapshot(self, callback):
+        with self.firestoreClient.lock:
+            self.firestoreClient.listeners.setdefault(self.id, []).append(callback)
+            snapshots = self.get()
+            readTime = self.firestoreClient.lastCommitTime
+
+        callback(snapshots, [], readTime)
+        return FakeWatch(self.firestoreClient, self.id, callback)
+
+'''
+description: in-memory stand-in for a firestore snapshot listener
+'''
+class FakeWatch:
+    def __init__(self, firestoreClient:FakeFirestore, collectionName:str, callback):
+        self.firestoreClient = firestoreClient
+        self.collectionName = collectionName
+        self.callback = callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        with self.firestoreClient.lock:
+            listeners = self.firestoreClient.listeners.get(self.collectionName, [])
+            if(self.callback in listeners):
+                listeners.remove(self.callback)
+
+'''
+description: in-memory stand-in for a firestore aggregation query. Only count is supported
+'''
+class FakeAggregationQuery:
+    def __init__(self, query:FakeQuery, alias:str):
+        self.query = query
+        self.alias = alias
+
+    def get(self, **kwargs) -> list:
+        return [[FakeAggregationResult(self.alias, sum(1 for _ in self.query.stream()))]]
+
+'''
+description: in-memory stand-in for a firestore aggregation result
+'''
+class FakeAggregationResult:
+    def __init__(self, alias:str, value:int):
+        self.alias = alias
+        self.value = value
+
+'''
+description: in-memory stand-in for a firestore write option, a precondition that the document was last updated at the given time
+'''
+class FakeWriteOption:
+    def __init__(self, lastUpdateTime:datetime):
+        self.last_update_time = lastUpdateTime
+
+'''
+description: in-memory stand-in for a firestore batched write. Writes are applied atomically on commit
+'''
+class FakeWriteBatch:
+    def __init__(self, firestoreClient:FakeFirestore):
+        self.firestoreClient = firestoreClient
+        self.writes = []
+
+    def create(self, reference:FakeDocumentReference, data:dict):
+        self.writes.append(('create', reference, data, None))
+
+    def set(self, reference:FakeDocumentReference, data:dict, **kwargs):
+        self.writes.append(('set', reference, data, None))
+
+    def delete(self, reference:FakeDocumentReference, option=None, **kwargs):
+        self.writes.append(('delete', reference, None, option))
+
+    def commit(self, **kwargs):
+        commitTime = self.firestoreClient.commit(self.writes)
+        self.writes = []
+        return commitTime
+
+'''
+description: in-memory stand-in for a firestore BulkWriter. Writes are applied one by one on flush, calling the result/error callbacks like BulkWriter
+'''
+class FakeBulkWriter:
+    def __init__(self, firestoreClient:FakeFirestore):
+        self.firestoreClient = firestoreClient
+        self.operations = []
+        self.onWriteResult = None
+        self.onWriteError = None
+
+    def on_write_result(self, callback):
+        self.onWriteResult = callback
+
+    def on_write_error(self, callback):
+        self.onWriteError = callback
+
+    def create(self, reference:FakeDocumentReference, data:dict):
+        self.operations.append(FakeBulkWriterOperation('create', reference, data))
+
+    def set(self, reference:FakeDocumentReference, data:dict, **kwargs):
+        self.operations.append(FakeBulkWriterOperation('set', reference, data))
+
+    def update(self, reference:FakeDocumentReference, data:dict, **kwargs):
+        self.operations.append(FakeBulkWriterOperation('update', reference, data))
+
+    def delete(self, reference:FakeDocumentReference, **kwargs):
+        self.operations.append(FakeBulkWriterOperation('delete', reference, None))
+
+    def flush(self):
+        operations = self.operations
+        self.operations = []
+
+        for operation in operations:
+            while(True):
+                operation.attempts += 1
+                try:
+                    commitTime = self.firestoreClient.commit([(operation.kind, operation.reference, operation.document_data, None)])
+                except (FakeConflictError, NotFound) as e:
+                    failure = FakeBulkWriteFailure(operation, 6 if type(e) is FakeConflictError else 5, str(e))#6 is ALREADY_EXISTS, 5 is NOT_FOUND status code
+                    if(self.onWriteError != None and self.onWriteError(failure, self)):
+                        continue#retry
+                    break
+
+                if(self.onWriteResult != None):
+                    self.onWriteResult(operation.reference, FakeWriteResult(commitTime), self)
+                break
+
+    def close(self):
+        self.flush()
+
+'''
+description: in-memory stand-in for an operation of firestore BulkWriter
+'''
+class FakeBulkWriterOperation:
+    def __init__(self, kind:str, reference:FakeDocumentReference, documentData:dict|None):
+        self.kind = kind
+        self.reference = reference
+        self.document_data = documentData
+        self.attempts = 0
+
+'''
+description: in-memory stand-in for a failed operation of firestore BulkWriter
+'''
+class FakeBulkWriteFailure:
+    def __init__(self, operation:FakeBulkWriterOperation, code:int, message:str):
+        self.operation = operation
+        self.code = code
+        self.message = message
+        self.attempts = operation.attempts
+
+'''
+description: in-memory stand-in for the result of a firestore write
+'''
+class FakeWriteResult:
+    def __init__(self, updateTime:datetime):
+        self.update_time = updateTime
+
+'''
+description: in-memory stand-in for firebase auth client, and for logging in with google identity toolkit api
+- tokens are not signed, they are just FAKE_ID_TOKEN_PREFIX + uid [see fakeIdToken]
+'''
+class FakeAuthClient:
+    def __init__(self, tokenLifetimeSeconds:int = 3600):
+        self.lock = threading.Lock()
+        self.usersByEmail = {}#email -> {'uid', 'password'}
+        self.tokenLifetimeSeconds = tokenLifetimeSeconds
+
+    def create_user(self, email:str, password:str, uid:str|None = None, **kwargs):
+        with self.lock:
+            if(email in self.usersByEmail):
+                raise auth.EmailAlreadyExistsError(f'User with email {email} already exists', None, None)
+
+            uid = uid or ''.join(random.choices(string.ascii_letters + string.digits, k=28))
+            self.usersByEmail[email] = {'uid': uid, 'password': password}
+            return uid
+
+    def verify_id_token(self, id_token:str, check_revoked:bool = False, **kwargs) -> dict:
+        if(type(id_token) is not str or not id_token.startswith(FAKE_ID_TOKEN_PREFIX) or len(id_token) == len(FAKE_ID_TOKEN_PREFIX)):
+            raise auth.InvalidIdTokenError('Not a fake ID token', None, None)
+
+        return {
+            'uid': id_token[len(FAKE_ID_TOKEN_PREFIX):],
+            'exp': int(time.time()) + self.tokenLifetimeSeconds,
+        }
+
+    '''
+    description: logs in, answering like google identity toolkit accounts:signInWithPassword api. Can be given to main.configureServices as signInFunction
+    takes email:str|None, password:str|None
+    returns dict response json
+    '''
+    def sign_in_with_password(self, email:str|None, password:str|None) -> dict:
+        with self.lock:
+            user = self.usersByEmail.get(email)
+
+        if(user == None or user['password'] != password):
+            return {'error': {'code': 400, 'message': 'INVALID_LOGIN_CREDENTIALS'}}
+
+        return {
+            'idToken': fakeIdToken(user['uid']),
+            'localId': user['uid'],
+            'email': email,
+            'expiresIn': str(self.tokenLifetimeSeconds),
+        }
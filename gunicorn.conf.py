@@ -0,0 +1,16 @@
+'''
+description: gunicorn configuration for serving the backend in production
+Run using: gunicorn
+- WEB_CONCURRENCY: number of worker processes
+- THREADS: number of threads per worker process. Each request keeps its user in flask's request context, so threads are safe to use
+- PORT: port to listen on
+'''
+import multiprocessing
+import os
+
+wsgi_app = 'main:createApp()'#app factory, called in every worker process after fork
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv('THREADS', '4'))
+timeout = int(os.getenv('TIMEOUT', '30'))
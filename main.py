@@ -25,30 +25,64 @@ This project [backend] deserves Level 4 because:
 - Data modelling done in firestore
 '''
 
+import time
+startedImportingAt = time.perf_counter()#for reporting how long starting up takes [see startupTimings]
+
 #refereced syntax from https://flask.palletsprojects.com/en/3.0.x/quickstart/, implemented on my own
 #refereced syntax from https://medium.com/google-cloud/building-a-flask-python-crud-api-with-cloud-firestore-firebase-and-deploying-on-cloud-run-29a10c502877, implemented on my own
-from flask import Flask, request, jsonify
-from firebase_admin import credentials, firestore, auth, exceptions, initialize_app
+from flask import Flask, request, jsonify, g, Response, stream_with_context
+from firebase_admin import credentials, firestore, auth, exceptions, initialize_app, get_app
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, BulkRetry
+from google.api_core.exceptions import FailedPrecondition
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import json
+import base64
+import bisect
+import contextlib
+import contextvars
+import functools
+import itertools
+import re
+import codecs
+import queue
+import hashlib
+from collections import OrderedDict
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 from collections.abc import Callable
 
-app = Flask(__name__) #initialize the main central object
+#optional faster json encoder and brotli compression for streamed responses. Used only if installed [pip install orjson brotli]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-#initialize firebase
-cred = credentials.Certificate('./config/key.json')
-firebaseApp = initialize_app(cred)
+app = Flask(__name__) #initialize the main central object
 
-#initialize firestore [realtime database]
-db = firestore.client()
+#firebase services, set by configureServices. Either real firebase [created on first use, see ensureServicesInitialized] or stand-ins for tests and benchmarks [see fakeFirebase.py]
+#firestore [realtime database]
+db = None
 
 #references of collections in firestore.
-approvedListingsRef = db.collection('ApprovedListings') #primarily displayed to end user . Listings that have been approved with the admin only end up here
-unapprovedListingsRef = db.collection('UnapprovedListings')#displayed to admin also, so that the admin can approve these unapproved listings
+approvedListingsRef = None #primarily displayed to end user . Listings that have been approved with the admin only end up here
+unapprovedListingsRef = None#displayed to admin also, so that the admin can approve these unapproved listings
+listingTombstonesRef = None#records of listings removed from the above collections [approved or rejected], so frontend can sync only changes
+
+#firebase authentication
+firebase_auth:auth.Client = None
 
-#initialize firebase authentication
-firebase_auth:auth.Client = auth.Client(firebaseApp)
+#logs in with email and password, returns response json of google identity toolkit api or None if it is unavailable
+signInWithPassword:Callable = None
 
 #dictionary for http codes. To be sent as API call results
 
@@ -67,6 +101,22 @@ incompleteDict = {
     'status': 400
 }
 
+#sent if a since watermark is older than removed listings are remembered for. Frontend has to get all listings again for a new watermark
+resyncDict = {
+    'status': 400,
+    'resync': True
+}
+
+#sent if firestore took too long to answer
+timeoutDict = {
+    'status': 504
+}
+
+#sent if google login service is down or not responding
+serviceUnavailableDict = {
+    'status': 503
+}
+
 #sent if the auth Token is expired, i.e., the user needs to re-login or the user credentials are wrong
 unauthorizedDict = {
     'status': 403
@@ -80,7 +130,98 @@ load_dotenv('./config/.env') #load the file
 ADMIN_TOKEN:str|None = os.getenv('ADMIN_UID')#used for checking whether the user [authtoken] is an admin or not 
 API_KEY:str|None = os.getenv('API_KEY')#used for making calls to google apis for firebase login
 
-uid = None
+#google identity toolkit api used for logging in. URL can be changed to a local stub for tests and benchmarks
+IDENTITY_TOOLKIT_URL:str = os.getenv('IDENTITY_TOOLKIT_URL', 'https://identitytoolkit.googleapis.com').rstrip('/')
+IDENTITY_TOOLKIT_CONNECT_TIMEOUT:float = float(os.getenv('IDENTITY_TOOLKIT_CONNECT_TIMEOUT', '3'))
+IDENTITY_TOOLKIT_READ_TIMEOUT:float = float(os.getenv('IDENTITY_TOOLKIT_READ_TIMEOUT', '10'))
+IDENTITY_TOOLKIT_RETRIES = 2
+IDENTITY_TOOLKIT_POOL_SIZE:int = int(os.getenv('IDENTITY_TOOLKIT_POOL_SIZE', '32'))
+#failures in a row after which logins fail right away for the cooldown seconds
+IDENTITY_TOOLKIT_CIRCUIT_FAILURES = 5
+IDENTITY_TOOLKIT_CIRCUIT_COOLDOWN:float = float(os.getenv('IDENTITY_TOOLKIT_CIRCUIT_COOLDOWN', '30'))
+
+#pagination of listings. Page size used when only cursor is given, and the largest page size allowed
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+#fields stored in a listing document, that can be asked for in get-connections
+LISTING_FIELDS = ('title', 'description', 'authorId', 'type', 'link', 'location', 'updatedAt')
+
+#watermarks are counted from this time
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+#seconds a watermark is set back from the time its queries started, in case firestore's clock is slightly behind this server's
+WATERMARK_CLOCK_MARGIN:float = float(os.getenv('WATERMARK_CLOCK_MARGIN', '1'))
+#days removed listings are remembered for syncing only changes. Older tombstones are deleted by a firestore TTL policy on expireAt,
+#so a watermark older than this can't be synced from anymore and the frontend has to get all listings again
+TOMBSTONE_RETENTION_DAYS:float = float(os.getenv('TOMBSTONE_RETENTION_DAYS', '30'))
+
+#types of listings
+LISTING_TYPES = ('whatsapp', 'facebook')
+
+#search by words. Shorter words are not searchable, and at most this many words of a listing are searchable
+MIN_SEARCH_KEYWORD_LENGTH = 2
+MAX_SEARCH_KEYWORDS = 200
+
+#key of a page cursor that carries the watermark of the pagination, next to the last listing id given out from each source
+PAGE_WATERMARK_KEY = 'watermark'
+
+#special field path which orders documents by their document id [listingId]
+DOCUMENT_ID_FIELD = '__name__'
+#longest document id firestore allows
+MAX_DOCUMENT_ID_BYTES = 1500
+
+#in-memory copy of approved listings kept up to date by a snapshot listener. Turned off by default
+APPROVED_LISTINGS_VIEW_ENABLED:bool = (os.getenv('APPROVED_LISTINGS_VIEW') == 'true')
+#seconds between checks that the snapshot listener is still alive. While it isn't, firestore is read instead and the listener is restarted
+APPROVED_LISTINGS_VIEW_CHECK_INTERVAL:float = float(os.getenv('APPROVED_LISTINGS_VIEW_CHECK_INTERVAL', '5'))
+#seconds between probes that read the newest approved listing [1 read] and check that the copy has it, as a listener can stay alive but stop sending updates
+APPROVED_LISTINGS_VIEW_PROBE_INTERVAL:float = float(os.getenv('APPROVED_LISTINGS_VIEW_PROBE_INTERVAL', '60'))
+#seconds the copy is used without being confirmed up to date by a listener update or a probe. After that firestore is read instead and the listener is restarted
+APPROVED_LISTINGS_VIEW_MAX_STALENESS:float = float(os.getenv('APPROVED_LISTINGS_VIEW_MAX_STALENESS', '300'))
+
+#max number of listings that can be approved/rejected in one call
+MAX_BULK_MODERATION_SIZE = 1000
+#listings moved per batched write. A batched write allows 500 writes, and approving a listing takes 3 [create approved + delete unapproved + tombstone]
+MODERATION_BATCH_SIZE = 150
+
+#bulk upload of listings. Listings written before waiting for their results, and throttling/retries of the BulkWriter
+BULK_CREATE_FLUSH_SIZE = 500
+BULK_CREATE_INITIAL_OPS_PER_SECOND = int(os.getenv('BULK_CREATE_INITIAL_OPS_PER_SECOND', '500'))
+BULK_CREATE_MAX_OPS_PER_SECOND = int(os.getenv('BULK_CREATE_MAX_OPS_PER_SECOND', '10000'))
+BULK_CREATE_MAX_ATTEMPTS = 5
+#bytes of a streamed response compressed and sent at a time
+STREAM_CHUNK_SIZE = 16 * 1024
+#bytes of an uploaded JSON array read at a time
+JSON_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+#seconds connection stats are cached for, and how many different breakdowns are cached
+STATS_CACHE_SECONDS:float = float(os.getenv('STATS_CACHE_SECONDS', '30'))
+STATS_CACHE_MAX_SIZE = 100
+#max number of locations or authors the stats can be broken down by in one call
+MAX_STATS_BREAKDOWN_SIZE = 20
+#threads for running count queries of stats, apart from the ones of get-connections. Bounds how many counts run at once
+STATS_QUERY_THREADS:int = int(os.getenv('STATS_QUERY_THREADS', '4'))
+
+#seconds each firestore query of a request may take before the request fails with 504, instead of hanging
+FIRESTORE_QUERY_TIMEOUT:float = float(os.getenv('FIRESTORE_QUERY_TIMEOUT', '10'))
+#threads shared by all requests for running firestore queries concurrently
+FIRESTORE_QUERY_THREADS:int = int(os.getenv('FIRESTORE_QUERY_THREADS', '16'))
+
+#cache of verified auth tokens, so the same token isn't verified again on every call
+TOKEN_CACHE_MAX_SIZE:int = int(os.getenv('TOKEN_CACHE_MAX_SIZE', '10000'))
+#seconds after which a cached token is checked again for being revoked [e.g. user disabled or signed out everywhere]. 0 means never check
+TOKEN_REVOCATION_CHECK_INTERVAL:float = float(os.getenv('TOKEN_REVOCATION_CHECK_INTERVAL', '0'))
+
+#upper bounds of histogram buckets, in seconds for latency and number of documents for firestore reads/writes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DOCUMENT_COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+#print one JSON line with timings of every request. Turned off by default
+REQUEST_TIMING_LOGS_ENABLED:bool = (os.getenv('REQUEST_TIMING_LOGS') == 'true')
+
+#real firebase is not used when true, stand-ins are configured instead [e.g. by benchmark.py]
+FIREBASE_SKIP_INIT:bool = (os.getenv('FIREBASE_SKIP_INIT') == 'true')
+
 #syntax referenced from https://stackoverflow.com/questions/14993318/catching-a-500-server-error-in-flask, implemented on my own
 
 '''
@@ -92,12 +233,88 @@ returns dictionary with http code as response
 def handleError(error):
     return errorDict
 
+'''
+description: middleware: starts measuring the request. Registered before verifyTokenMiddleware, so token verification is measured too
+takes nothing
+returns nothing
+'''
+@app.before_request
+def startRequestMetrics():
+    g.requestStartedAt = time.perf_counter()
+    g.requestMetrics = {
+        'firestoreReads': 0,
+        'firestoreWrites': 0,
+        'authSeconds': 0.0,
+    }
+
+    #context variable instead of g, so firestore reads in shared threads are counted for this request too
+    requestMetricsVar.set(g.requestMetrics)
+
+'''
+description: middleware: records latency, status and firestore usage of the request, after it is processed
+takes response: flask Response
+returns the same response
+'''
+@app.after_request
+def finishRequestMetrics(response):
+    if('requestStartedAt' not in g):
+        return response
+
+    durationSeconds = time.perf_counter() - g.requestStartedAt
+    endpoint = request.endpoint or 'unmatched'
+    status = g.get('resultStatus', response.status_code)#most APIs send their status inside JSON body, as set by instrumentRoutes
+    requestMetrics = g.requestMetrics
+
+    observeHistogram('http_request_duration_seconds', (('endpoint', endpoint),), durationSeconds)
+    incrementCounter('http_requests_total', (('endpoint', endpoint), ('status', str(status))))
+
+    timingLog = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': endpoint,
+        'status': status,
+        'durationMs': round(durationSeconds * 1000, 3),
+        'authMs': round(requestMetrics['authSeconds'] * 1000, 3),
+        'streamed': response.is_streamed,#time of streamed responses doesn't include sending the body
+    }
+
+    #documents read/written, known only once the whole response was made. The body of a streamed response is made after this, while it is sent
+    def recordDocumentUsage():
+        observeHistogram('firestore_documents_read_per_request', (('endpoint', endpoint),), requestMetrics['firestoreReads'], DOCUMENT_COUNT_BUCKETS)
+        observeHistogram('firestore_documents_written_per_request', (('endpoint', endpoint),), requestMetrics['firestoreWrites'], DOCUMENT_COUNT_BUCKETS)
+
+        if(REQUEST_TIMING_LOGS_ENABLED):
+            timingLog['firestoreReads'] = requestMetrics['firestoreReads']
+            timingLog['firestoreWrites'] = requestMetrics['firestoreWrites']
+            print(json.dumps(timingLog))
+
+    if(response.is_streamed):
+        response.call_on_close(recordDocumentUsage)#called by the server after the body was sent, or the client went away
+    else:
+        recordDocumentUsage()
+
+    return response
+
+'''
+description: middleware: creates firebase services on the first API call that needs them, instead of on import, so the server starts faster
+- not needed for the default path [health checks] and metrics api, so these answer right away even while firebase is still starting
+takes nothing
+returns dictionary with http code as response, if firebase could not be started
+'''
+@app.before_request
+def initializeServicesMiddleware():
+    if(request.path == '/' or request.path == '/metrics'):
+        return
+
+    if(not ensureServicesInitialized()):
+        return serviceUnavailableDict
+
 #middleware
 '''
 description: middleware: 
 - intervenes before any API call is processed. Called for every API call
-- helps detect User ID from the oauth token coming from frontend
-- wouldn't check auth token in case of login or signup api, as the token has not been assigned yet.
+- helps detect User ID from the oauth token coming from frontend. Stored in g.uid, which belongs to this request only, so parallel requests never see each other's user
+- wouldn't check auth token in case of login or signup api, as the token has not been assigned yet. Also not for metrics api and default path, which are read by monitoring and health checks
 
 takes nothing
 returns dictionary with http code as response
@@ -105,12 +322,11 @@ returns dictionary with http code as response
 @app.before_request
 def verifyTokenMiddleware():
     #extracted from auth token
-    global uid
-    uid = None
+    g.uid = None
 
     #to get different segments of API call URL
     urlSegment = request.path
-    if(urlSegment != '/login' and urlSegment != '/sign-up'):
+    if(urlSegment != '/login' and urlSegment != '/sign-up' and urlSegment != '/metrics' and urlSegment != '/'):
         #prevents auth token checking in case API call is for logging in or signing up, as the token is anyways not assigned then
         
         #if no token is found, then return incomplete request
@@ -126,12 +342,21 @@ def verifyTokenMiddleware():
         else:
             try:
                 #verify if token is not fake and not expired. Also extracts User ID from auth token code
-                uid = verifyIfTokenIsValid(tokenId)
+                g.uid = verifyIfTokenIsValid(tokenId)
             except Exception as e:
                 #error handling
                 print(f'Exception occurred while verifying tokenId: {e}')
                 return unauthorizedDict
 
+'''
+description: metrics api endpoint. helps monitoring [e.g. prometheus] see latency, errors and firestore usage of the backend. Doesn't need auth token
+takes nothing
+returns metrics in prometheus text format
+'''
+@app.route("/metrics", methods=['GET'])
+def sendMetrics():
+    return Response(renderMetrics(), mimetype='text/plain; version=0.0.4')
+
 '''
 description: Just to check if the backend is up or not. default path
 takes nothing
@@ -157,18 +382,14 @@ def login():
         email = request.form.get('email')
         password = request.form.get('password')
 
-        #payload for google api call
-        bodyDict = {
-            'email': email,
-            'password': password,
-            'returnSecureToken': True #helps get the correct authToken back for this user
-        }
-
-        #syntax referenced from https://www.educative.io/answers/how-to-make-api-calls-in-python, implemented on my own
-        response = requests.post(f'https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={API_KEY}', json=(bodyDict)) #login call to Google API
-        responseJson = response.json()#deserialize json and get dictionary
+        responseJson = signInWithPassword(email, password) #login call to Google API
 
         print('Logging in')
+        if(responseJson == None):
+            #google is down or not responding, fail fast instead of making the user wait
+            print('Login service unavailable')
+            return serviceUnavailableDict
+
         if('idToken' in responseJson):
             #success
             print('Success')
@@ -252,30 +473,17 @@ returns JSON
 @app.route("/create-connection", methods=['POST'])
 def createConnection():
     try:
-        #extract data from form request body
-        title = request.form.get('title')
-        description = request.form.get('description')
-        authorId = uid #uid as extracted from authtoken already
-        type = request.form.get('type')
-        link = request.form.get('link')
-        location = request.form.get('location')
-
-        #payload for firestore
-        responseDict = {
-            'title': title,
-            'description': description,
-            'authorId': authorId,
-            'type': type,
-            'link': link,
-            'location': location,
-        }
+        #payload for firestore, from form request body. uid as extracted from authtoken already
+        responseDict = buildListingDocument(request.form, g.uid)
 
         #if inadequate info was given from frontend, return 400 http code
-        if(title == None or description == None or authorId == None or type == None or location == None):
+        if(responseDict == None):
             return incompleteDict
 
         #create a document with auto ID, and creates a new document with with responseDict keys as fieldnames and their values as field values
-        unapprovedListingsRef.document().create(responseDict)
+        with timeFirestoreOperation('unapproved', 'create'):
+            unapprovedListingsRef.document().create(responseDict)
+        recordFirestoreWrites(1)
 
         return successDict
     except Exception as e:
@@ -283,6 +491,39 @@ def createConnection():
         print(f"An error occurred while creating connection: {e}")
         raise Exception(e)
 
+'''
+description: create-connections api endpoint. helps create many connection listings at once, e.g. when onboarding a whole community
+- listings are read from the request body one by one while they are being written, so the whole upload is never in memory at once
+- listings are written using firestore BulkWriter, which throttles and retries writes
+API takes in request body, either as a JSON array [Content-Type: application/json] or one JSON per line [Content-Type: application/x-ndjson], of listings with:
+    title:str
+    description:str
+    type:str, should be either 'whatsapp' or 'facebook'
+    link:str
+    location:str
+returns one JSON per line [streamed back while the upload is processed], for each listing:
+    'index': int, position of the listing in the upload
+    'status': int, 200 if created, 400 if the listing is incomplete or not valid JSON, 500 if writing failed
+    'listingId': str, only if created
+'''
+@app.route("/create-connections", methods=['POST'])
+def createConnections():
+    try:
+        contentType = request.mimetype
+        if(contentType == 'application/json'):
+            records = iterateJsonArrayRecords(request.stream)
+        elif(contentType in ('application/x-ndjson', 'application/jsonl')):
+            records = iterateNdjsonRecords(request.stream)
+        else:
+            return incompleteDict
+
+        #stream_with_context keeps the request [body and g.uid] available while the response is being streamed
+        return Response(stream_with_context(generateBulkCreateResults(records, g.uid)), mimetype='application/x-ndjson')
+    except Exception as e:
+        #unknown error handled by error handler declared before
+        print(f"An error occurred while creating connections: {e}")
+        raise Exception(e)
+
 '''
 description: approve-connection api endpoint. helps approve connection listing in database. Admin only access
 API takes in request body format:
@@ -298,13 +539,15 @@ def approveConnection():
         if(checkIfHasAdminAccess()):
             listingId = request.form.get('listingId')#get from form data request body 
 
-            unapprovedDocument = unapprovedListingsRef.document(listingId).get()#get the listing data by listingId [documentId] to be approved
+            if(listingId == None):
+                return incompleteDict
 
-            approvedListingsRef.document(listingId).create((unapprovedDocument.to_dict()))#add to approved collection
+            #moves the listing from unapproved to approved collection in one atomic write, so a crash can't leave it in both
+            results = moveUnapprovedListings([listingId], approve=True)
 
-            unapprovedListingsRef.document(listingId).delete()#delete this from unapproved collection, as it is now approved
-
-            return successDict
+            return {
+                'status': results[0]['status']
+            }
         else:
             #the person is not an admin and doesn't have access to this action.
             return unauthorizedDict
@@ -313,13 +556,56 @@ def approveConnection():
         print(f"An error occurred while approving connection with id {listingId} : {e}")
         raise Exception(e)
 
+'''
+description: approve-connections api endpoint. helps approve many connection listings at once. Admin only access
+API takes in request body, either as form data [listingIds repeated for each id] or JSON:
+    listingIds:list[str] ids of listings to be approved
+returns JSON
+    'status': int,
+    'data': list of JSON with 'listingId':str and 'status':int for each listing. 400 if the id is not a valid listing id, 404 if the listing is not waiting for approval,
+            409 if it was moderated by someone else at the same time
+'''
+@app.route("/approve-connections", methods=['POST'])
+def approveConnections():
+    return handleBulkModeration(approve=True)
+
+'''
+description: reject-connections api endpoint. helps reject many connection listings at once, i.e., deletes them without approving. Admin only access
+API takes in request body, either as form data [listingIds repeated for each id] or JSON:
+    listingIds:list[str] ids of listings to be rejected
+returns JSON
+    'status': int,
+    'data': list of JSON with 'listingId':str and 'status':int for each listing. 400 if the id is not a valid listing id, 404 if the listing is not waiting for approval,
+            409 if it was moderated by someone else at the same time
+'''
+@app.route("/reject-connections", methods=['POST'])
+def rejectConnections():
+    return handleBulkModeration(approve=False)
+
 '''
 description: get-connection api endpoint. helps get all connection listings from database
 API takes:
     unapproved: bool in form of query parameter. If true, this means admin access connections are also returned
+    limit: int in form of query parameter. Optional. If given, only this many listings are returned [one page]
+    cursor: str in form of query parameter. Optional. nextCursor returned by the previous page, to get the page after it
+    format: str in form of query parameter. Optional, only without pagination. 'stream' sends the same JSON while it is being read from database,
+            'ndjson' sends one JSON listing per line instead. Both are compressed with gzip or brotli if the frontend accepts it
+    fields: str in form of query parameter. Optional. Comma separated names of fields to return, e.g. 'title,type,location'. id and approved are always returned
+    location: str in form of query parameter. Optional. Only listings of this location are returned
+    type: str in form of query parameter. Optional. Only listings of this type ['whatsapp' or 'facebook'] are returned
+    search: str in form of query parameter. Optional. Only listings having all the words of this text in their title or description are returned.
+            Listings written before search existed are only found once backfillSearchKeywords.py was run
+    since: str in form of query parameter. Optional. watermark returned by a previous call. If given, only listings created, approved or removed
+           after that call are returned. fields, location, type and search still apply to the listings in data, limit, cursor and format are ignored.
+           A watermark older than TOMBSTONE_RETENTION_DAYS gets status 400 with 'resync': true, get all listings again for a new watermark
 returns JSON
     'status': int,
     'data': response from firebase in form of list of JSON of all documents that fit the criteria requested
+    'nextCursor': str|None, only when paginating. Send it back as cursor to get the next page, None if this was the last page
+    'watermark': str, only when not streaming, and when paginating only with the last page. Send it back as since to get only what changed after this call
+                  [or after the first page]. Paginating clients get their first watermark by paging through all listings once
+    'removed': list of JSON with 'id':str and 'approved':bool, only with since. Listings to remove, e.g. an approved listing is removed from
+               unapproved ones and comes again in data as approved. Apply removed before data. Not filtered by location, type or search
 '''
 @app.route("/get-connections", methods=['GET'])
 def getConnections():
@@ -335,89 +621,1970 @@ def getConnections():
             else:
                 #unauthorized. User is not an admin!!!
                 return unauthorizedDict
-        
-        allListings = []
-        docs = None
+
+        unapprovedQuery = None
         if(isAdmin):
             #get all unapproved documents
-            docs = unapprovedListingsRef.stream()
+            unapprovedQuery = unapprovedListingsRef
         else:
             #get only those unapproved documents that belong to that author/UID
-            docs = unapprovedListingsRef.where('authorId', '==', uid).get()
+            unapprovedQuery = unapprovedListingsRef.where('authorId', '==', g.uid)
+
+        #sources of listings. Unapproved ones are listed first, then the approved ones
+        sources = [
+            {'name': 'unapproved', 'query': unapprovedQuery, 'changeFieldParams': changeFieldParamsForUnverfiedDocs},
+            {'name': 'approved', 'query': approvedListingsRef, 'changeFieldParams': changeFieldParamsForVerifiedDocs},
+        ]
+
+        fieldsParam = request.args.get('fields')
+        if(fieldsParam != None):
+            fields = list(dict.fromkeys(fieldName.strip() for fieldName in fieldsParam.split(',')))#remove duplicates, keep order
+            if(not all(fieldName in LISTING_FIELDS for fieldName in fields)):
+                return incompleteDict
+
+            #only read the fields that the frontend shows
+            for source in sources:
+                source['fields'] = fields
+
+        #filters, done by firestore using its indexes instead of sending all listings to frontend
+        conditions = []
+
+        location = request.args.get('location')
+        if(location != None):
+            conditions.append(('location', '==', location))
+
+        listingType = request.args.get('type')
+        if(listingType != None):
+            if(listingType not in LISTING_TYPES):
+                return incompleteDict
+            conditions.append(('type', '==', listingType))
+
+        searchText = request.args.get('search')
+        if(searchText != None):
+            searchKeywords = tokenizeSearchText(searchText)
+            if(len(searchKeywords) == 0):
+                return incompleteDict
+
+            #longest word first, as it probably matches the fewest listings and firestore can only look up one word per query
+            for keyword in sorted(searchKeywords, key=len, reverse=True):
+                conditions.append(('keywords', 'array_contains', keyword))
+
+        for source in sources:
+            source['conditions'] = conditions
 
-        '''
-        description: callback for mutating a document dictionary fields with desirable information
-        takes:deserialized dictionary of document and the original serialized document from firestore
-        returns:modified doc in dictionary format
-        '''
-        def changeFieldParamsForUnverfiedDocs(doc, modifiedDoc):
-            modifiedDoc['id'] = doc.id#listingId
-            modifiedDoc['approved'] = False#as this was fetched from unapprovedCollection. Requires approval by admin
+        sinceParam = request.args.get('since')
+        if(sinceParam != None):
+            try:
+                since = decodeWatermark(sinceParam)
+            except ValueError as e:
+                print(f"Invalid watermark while getting connections: {e}")
+                return incompleteDict
+
+            if(isWatermarkTooOld(since)):
+                #listings removed since then may be forgotten already
+                return resyncDict
+
+            #only what changed, costs reads in proportion to the changes instead of all listings
+            return getChangedListings(sources, since, isAdmin)
+
+        #answer approved listings from the in-memory copy, if it is turned on and up to date. Saves reading the whole collection.
+        #A copy whose read time is unknown or too old to sync from is not used, as the watermark given out would be rejected by the next since call
+        approvedListingsViewCopy = getApprovedListingsViewSnapshots()
+        if(approvedListingsViewCopy != None and approvedListingsViewCopy[1] != None and not isWatermarkTooOld(approvedListingsViewCopy[1])):
+            sources[1]['snapshots'], sources[1]['snapshotsReadTime'] = approvedListingsViewCopy
+
+        limitParam = request.args.get('limit')
+        cursorParam = request.args.get('cursor')
+
+        if(limitParam == None and cursorParam == None):
+            responseFormat = request.args.get('format')
+            if(responseFormat == 'stream' or responseFormat == 'ndjson'):
+                #listings are sent as they are read, so memory stays flat and the first bytes get sent right away
+                return createStreamedListingsResponse(sources, isNdjson=(responseFormat == 'ndjson'))
+
+            #no pagination asked for, return all listings like before
+            watermark = watermarkBeforeReading()
+
+            allListings = []
+            for listings in fetchFromSourcesConcurrently(sources, lambda source: readSourceListings(source)):
+                allListings += listings#concatenate response list
 
-            return modifiedDoc
+            if('snapshots' in sources[1]):
+                #in-memory copy is only known to be complete up to its read time, changes after that must come again with since
+                watermark = min(watermark, sources[1]['snapshotsReadTime'])
 
-        allListings += convertDocumentsIntoResponseList(docs, changeFieldParamsForUnverfiedDocs)#concatenate response list
+            #success result
+            result = {
+                'status':200,
+                'data': allListings,
+                'watermark': encodeWatermark(watermark)
+            }
+
+            return result
+
+        try:
+            limit = DEFAULT_PAGE_SIZE if limitParam == None else int(limitParam)
+            positions = {} if cursorParam == None else decodePageCursor(cursorParam)
+        except ValueError as e:
+            #limit is not a number or the cursor was tampered with
+            print(f"Invalid pagination parameters while getting connections: {e}")
+            return incompleteDict
 
-        '''
-        description: callback for mutating a document dictionary fields with desirable information
-        takes:deserialized dictionary of document and the original serialized document from firestore
-        returns:modified doc in dictionary format
-        '''
-        def changeFieldParamsForVerifiedDocs(doc, modifiedDoc):
-            modifiedDoc['id'] = doc.id #listingId
-            modifiedDoc['approved'] = True #as this was fetched from approvedCollection. Approved by admin already
+        if(limit < 1 or limit > MAX_PAGE_SIZE):
+            return incompleteDict
 
-            return modifiedDoc
+        #watermark of the whole pagination, from before its first page was read. Carried in the cursor and given out with the last page
+        if(cursorParam == None):
+            pageWatermark = watermarkBeforeReading()
+        else:
+            try:
+                pageWatermark = decodeWatermark(positions[PAGE_WATERMARK_KEY]) if PAGE_WATERMARK_KEY in positions else None
+            except ValueError as e:
+                print(f"Invalid pagination parameters while getting connections: {e}")
+                return incompleteDict
+        if('snapshots' in sources[1] and pageWatermark != None):
+            #in-memory copy is only known to be complete up to its read time, same as without pagination
+            pageWatermark = min(pageWatermark, sources[1]['snapshotsReadTime'])
+        if(pageWatermark != None):
+            positions[PAGE_WATERMARK_KEY] = encodeWatermark(pageWatermark)
 
-        #get documents that are approved from approved collection
-        docs = approvedListingsRef.stream()
-        allListings += convertDocumentsIntoResponseList(docs, changeFieldParamsForVerifiedDocs)#concatenate response list
+        pageListings, nextCursor = fetchListingsPage(sources, limit, positions)
 
         #success result
         result = {
             'status':200,
-            'data': allListings
+            'data': pageListings,
+            'nextCursor': nextCursor
         }
 
+        if(nextCursor == None and pageWatermark != None and not isWatermarkTooOld(pageWatermark)):
+            #a pagination that took longer than removed listings are remembered for gets no watermark, frontend has to page through again
+            result['watermark'] = encodeWatermark(pageWatermark)
+
         return result
+    except FutureTimeoutError:
+        #one of the queries took too long, fail instead of making the user wait forever
+        print("Timed out while getting connections")
+        return timeoutDict
     except Exception as e:
         #error handling incase of unexpected error. Goes to error handler at beginning of file
         print(f"An error occurred while getting connections: {e}")
         raise Exception(e)
 
+'''
+description: connection-stats api endpoint. helps admin see how big the approval backlog is, without reading all listings. Admin only access
+- uses firestore count aggregation queries, which cost one read per 1000 listings counted instead of one per listing
+- results are cached for a few seconds, so dashboards can poll this often
+API takes:
+    locations: str in form of query parameter. Optional. Comma separated locations to count listings of
+    authorIds: str in form of query parameter. Optional. Comma separated user ids to count listings of
+returns JSON
+    'status': int,
+    'data': JSON with 'pending' [waiting for approval] and 'approved', each with
+            'total': int, 'byType': JSON type -> int, 'byLocation': JSON location -> int, 'byAuthor': JSON authorId -> int
+'''
+@app.route("/connection-stats", methods=['GET'])
+def getConnectionStats():
+    try:
+        if(not checkIfHasAdminAccess()):
+            #the person is not an admin and doesn't have access to this action.
+            return unauthorizedDict
+
+        locations = splitQueryParamList(request.args.get('locations'))
+        authorIds = splitQueryParamList(request.args.get('authorIds'))
+        if(len(locations) > MAX_STATS_BREAKDOWN_SIZE or len(authorIds) > MAX_STATS_BREAKDOWN_SIZE):
+            return incompleteDict
+
+        result = {
+            'status': 200,
+            'data': getCachedListingStats(tuple(locations), tuple(authorIds))
+        }
+
+        return result
+    except FutureTimeoutError:
+        #one of the counts took too long, fail instead of making the user wait forever
+        print("Timed out while getting connection stats")
+        return timeoutDict
+    except Exception as e:
+        #unknown error handled by error handler declared before
+        print(f"An error occurred while getting connection stats: {e}")
+        raise Exception(e)
+
 #************NON API HELPER METHODS*************
+
 '''
-description: goes over each document and deserializes it. Also, helps do a callback over each document
-takes 
-    docs:list of documents fetched from firestore collection
-    changeFieldParams:callback that should return a modified doc, and is given deserialized dictionary of document and the original serialized document
-returns all modified document in form of list[dict]
+description: splits a comma separated query parameter into its values, without empty values and duplicates
+takes param:str|None
+returns list[str]
 '''
-def convertDocumentsIntoResponseList(docs, changeFieldParams):
-    allListings = []
+def splitQueryParamList(param:str|None) -> list:
+    if(param == None):
+        return []
+    return list(dict.fromkeys(value.strip() for value in param.split(',') if value.strip() != ''))
 
-    #go over all docs
-    for doc in docs:
-        modifiedDoc = doc.to_dict()#convert to dictionary
-        modifiedDoc = changeFieldParams(doc, modifiedDoc)#helps carry any changes to each document
-        
-        allListings.append(modifiedDoc)
-    
-    return allListings
+'''
+description: gets stats of listings from cache, or counts them if they are not cached or the cached ones are too old
+takes locations:tuple of str, authorIds:tuple of str, to break the counts down by
+returns dict stats, as described by connection-stats api
+'''
+def getCachedListingStats(locations:tuple, authorIds:tuple) -> dict:
+    cacheKey = (locations, authorIds)
+
+    with listingStatsCache['lock']:
+        cached = listingStatsCache['entries'].get(cacheKey)
+        if(cached != None and (time.monotonic() - cached['countedAt']) < STATS_CACHE_SECONDS):
+            return cached['stats']
+
+    stats = countListingStats(locations, authorIds)
+
+    with listingStatsCache['lock']:
+        listingStatsCache['entries'][cacheKey] = {'stats': stats, 'countedAt': time.monotonic()}
+        listingStatsCache['entries'].move_to_end(cacheKey)
+        while(len(listingStatsCache['entries']) > STATS_CACHE_MAX_SIZE):
+            listingStatsCache['entries'].popitem(last=False)#oldest
+
+    return stats
 
 '''
-description: checks if the user is an admin or not
+description: counts listings with count aggregation queries, a few of them at a time [STATS_QUERY_THREADS]
+takes locations:tuple of str, authorIds:tuple of str, to break the counts down by
+returns dict stats, as described by connection-stats api
+'''
+def countListingStats(locations:tuple, authorIds:tuple) -> dict:
+    #one count query for each number in the stats
+    countQueries = []
+    for statusName, collectionRef in (('pending', unapprovedListingsRef), ('approved', approvedListingsRef)):
+        countQueries.append({'name': (statusName, 'total', None), 'query': collectionRef})
+        for listingType in LISTING_TYPES:
+            countQueries.append({'name': (statusName, 'byType', listingType), 'query': collectionRef.where('type', '==', listingType)})
+        for location in locations:
+            countQueries.append({'name': (statusName, 'byLocation', location), 'query': collectionRef.where('location', '==', location)})
+        for authorId in authorIds:
+            countQueries.append({'name': (statusName, 'byAuthor', authorId), 'query': collectionRef.where('authorId', '==', authorId)})
+
+    #on threads of their own, so many counts waiting for a thread can't hold up the queries of get-connections calls
+    counts = fetchFromSourcesConcurrently(countQueries, lambda countQuery: countDocuments(countQuery['query']), statsQueryExecutor)
+
+    stats = {}
+    for countQuery, count in zip(countQueries, counts):
+        statusName, breakdown, key = countQuery['name']
+        statusStats = stats.setdefault(statusName, {'total': 0, 'byType': {}, 'byLocation': {}, 'byAuthor': {}})
+        if(breakdown == 'total'):
+            statusStats['total'] = count
+        else:
+            statusStats[breakdown][key] = count
+
+    return stats
+
+'''
+description: counts documents of a query on the firestore server, without reading them
+takes query:firestore query/collection
+returns int number of documents
+'''
+def countDocuments(query) -> int:
+    with timeFirestoreOperation('stats', 'count'):
+        results = query.count(alias='count').get(timeout=FIRESTORE_QUERY_TIMEOUT)
+
+    return int(results[0][0].value)
+
+'''
+description: initializes real firebase services, using credentials from ./config/key.json
 takes nothing
-returns True if user is admin or False if the user is not
+returns nothing
 '''
-def checkIfHasAdminAccess() -> bool:
-    return (uid == ADMIN_TOKEN)
+def initializeFirebase():
+    #initialize firebase. The app might exist already if creating the clients failed on an earlier try, and can only be initialized once
+    try:
+        firebaseApp = get_app()
+    except ValueError:
+        cred = credentials.Certificate('./config/key.json')
+        firebaseApp = initialize_app(cred)
+
+    configureServices(firestore.client(), auth.Client(firebaseApp), signInWithIdentityToolkit)
 
 '''
-description: checks if the token is valid or not
-takes token:str
-returns userId:str extracted from the token
+description: makes sure firebase services are set, creating real firebase the first time it is called. Safe to call from many threads at once, firebase is created only once
+- if creating firebase fails [e.g. missing ./config/key.json], it is tried again on the next call
+takes nothing
+returns True if services are set, False if they couldn't be created
 '''
-def verifyIfTokenIsValid(tokenId:str) -> str|None:
-    decodedToken = auth.verify_id_token(tokenId)
-    return decodedToken['uid']
\ No newline at end of file
+def ensureServicesInitialized() -> bool:
+    if(servicesState['configured']):
+        return True#already set, no need to lock
+
+    with servicesState['lock']:
+        if(servicesState['configured']):
+            return True#another thread created them while waiting for the lock
+        if(FIREBASE_SKIP_INIT):
+            return False#stand-ins are expected to be configured, but weren't yet
+
+        startedAt = time.perf_counter()
+        try:
+            initializeFirebase()
+        except Exception as e:
+            print(f'Exception occurred while initializing firebase: {e}')
+            return False
+        startupTimings['firebaseInitSeconds'] = time.perf_counter() - startedAt
+
+    return True
+
+'''
+description: sets the firebase services used by the backend. Lets tests and benchmarks run without a firebase project, using stand-ins [e.g. fakeFirebase.py]
+takes
+    firestoreClient: firestore client, or a stand-in with the same methods
+    authClient: firebase auth client, or a stand-in with the same methods
+    signInFunction: callable(email:str, password:str) -> dict|None used for logging in. Defaults to calling google identity toolkit api
+returns nothing
+'''
+def configureServices(firestoreClient, authClient, signInFunction:Callable|None = None):
+    global db, approvedListingsRef, unapprovedListingsRef, listingTombstonesRef, firebase_auth, signInWithPassword
+
+    db = firestoreClient
+    approvedListingsRef = db.collection('ApprovedListings')
+    unapprovedListingsRef = db.collection('UnapprovedListings')
+    listingTombstonesRef = db.collection('ListingTombstones')
+    firebase_auth = authClient
+    signInWithPassword = signInFunction or signInWithIdentityToolkit
+    servicesState['configured'] = True
+
+'''
+description: logs in with email and password using google identity toolkit api
+takes email:str|None, password:str|None
+returns dict response json, or None if the api is unavailable
+'''
+def signInWithIdentityToolkit(email:str|None, password:str|None) -> dict|None:
+    #payload for google api call
+    bodyDict = {
+        'email': email,
+        'password': password,
+        'returnSecureToken': True #helps get the correct authToken back for this user
+    }
+
+    return callIdentityToolkit('/v1/accounts:signInWithPassword', bodyDict)
+
+'''
+description: calls google identity toolkit api [firebase authentication REST api], e.g. for logging in
+- uses a shared session, so connections are kept alive and reused instead of connecting again on every call
+- calls time out, transient errors are retried a few times, and after too many failures in a row calls fail right away for a while [circuit breaker]
+takes
+    path:str path of the api, e.g. '/v1/accounts:signInWithPassword'
+    body:dict JSON body of the call
+returns dict response json, or None if the api is unavailable
+'''
+def callIdentityToolkit(path:str, body:dict) -> dict|None:
+    with identityToolkitCircuit['lock']:
+        if(time.monotonic() < identityToolkitCircuit['openUntil']):
+            return None#too many failures recently, don't even try
+
+    try:
+        #syntax referenced from https://www.educative.io/answers/how-to-make-api-calls-in-python, implemented on my own
+        response = identityToolkitSession.post(f'{IDENTITY_TOOLKIT_URL}{path}', params={'key': API_KEY}, json=body, timeout=(IDENTITY_TOOLKIT_CONNECT_TIMEOUT, IDENTITY_TOOLKIT_READ_TIMEOUT))
+        isFailure = response.status_code >= 500
+    except requests.RequestException as e:
+        print(f'Exception occurred while calling identity toolkit: {e}')
+        response = None
+        isFailure = True
+
+    with identityToolkitCircuit['lock']:
+        if(isFailure):
+            identityToolkitCircuit['failures'] += 1
+            if(identityToolkitCircuit['failures'] >= IDENTITY_TOOLKIT_CIRCUIT_FAILURES):
+                #open the circuit. After the cooldown one more failure opens it again right away, as failures are not reset
+                identityToolkitCircuit['openUntil'] = time.monotonic() + IDENTITY_TOOLKIT_CIRCUIT_COOLDOWN
+        else:
+            identityToolkitCircuit['failures'] = 0
+
+    if(isFailure):
+        return None
+
+    return response.json()#deserialize json and get dictionary
+
+'''
+description: creates the shared session for calling identity toolkit api, with a pool of kept alive connections and retries of transient errors
+takes nothing
+returns requests.Session
+'''
+def createIdentityToolkitSession() -> requests.Session:
+    retry = Retry(
+        total=IDENTITY_TOOLKIT_RETRIES,
+        read=0,#a login that timed out might have gone through, not retried so a slow google doesn't get more load
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['POST']),#signing in doesn't change anything, so it is safe to retry
+        backoff_factor=0.2,
+        respect_retry_after_header=False,#a long Retry-After from google would make the call wait far longer than its timeouts
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=IDENTITY_TOOLKIT_POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)#for a local stub standing in for google
+    return session
+
+'''
+description: builds the firestore document of a new listing, and checks that all required fields are there
+takes
+    fields:dict-like [form data or JSON dict] with 'title', 'description', 'type', 'link', 'location'
+    authorId:str|None uid of the user creating the listing
+returns dict document for firestore, or None if some required field is missing
+'''
+def buildListingDocument(fields, authorId:str|None) -> dict|None:
+    #payload for firestore
+    listingDocument = {
+        'title': fields.get('title'),
+        'description': fields.get('description'),
+        'authorId': authorId,
+        'type': fields.get('type'),
+        'link': fields.get('link'),
+        'location': fields.get('location'),
+    }
+
+    #if inadequate info was given from frontend, it can't be created
+    for fieldName in ('title', 'description', 'authorId', 'type', 'location'):
+        if(listingDocument[fieldName] == None):
+            return None
+
+    #JSON can have any type of values, form data only has strings
+    for value in listingDocument.values():
+        if(value != None and type(value) is not str):
+            return None
+
+    listingDocument['updatedAt'] = firestore.SERVER_TIMESTAMP#creation time, for syncing only changes
+    listingDocument['keywords'] = buildSearchKeywords(listingDocument)#for searching by words
+    return listingDocument
+
+'''
+description: builds the search keywords of a listing, i.e., all words of its title and description
+- stored as an array field in the listing. Firestore indexes every element of an array, so looking up a word only reads the listings having it
+takes listingDocument:dict listing with 'title' and 'description'
+returns list[str] keywords
+'''
+def buildSearchKeywords(listingDocument:dict) -> list:
+    text = f"{listingDocument.get('title') or ''} {listingDocument.get('description') or ''}"
+    return tokenizeSearchText(text)[:MAX_SEARCH_KEYWORDS]
+
+'''
+description: splits text into lowercase words, without duplicates. Used the same way for listings and for searched text, so they match
+takes text:str
+returns list[str] words, in the order they first appear
+'''
+def tokenizeSearchText(text:str) -> list:
+    words = re.findall(r'\w+', text.lower())
+    return list(dict.fromkeys(word for word in words if len(word) >= MIN_SEARCH_KEYWORD_LENGTH))
+
+'''
+description: writes listings of a bulk upload with firestore BulkWriter, and yields the result of each listing as soon as it is known
+- BulkWriter is flushed every BULK_CREATE_FLUSH_SIZE listings, so only that many listings are waiting in memory at a time
+takes
+    records:iterable of dict|None listings as read from the upload, None for a listing that wasn't valid JSON
+    authorId:str uid of the user uploading
+returns generator of str, one JSON line per listing
+'''
+def generateBulkCreateResults(records, authorId:str):
+    #BulkWriter calls back from its own threads, results are passed to this generator through the queue
+    resultQueue = queue.SimpleQueue()
+    #the callback threads don't have the request's context, so its metrics are passed to them
+    requestMetrics = requestMetricsVar.get(None)
+
+    def onWriteResult(reference, writeResult, bulkWriter):
+        recordFirestoreWrites(1, requestMetrics)
+        resultQueue.put((reference.id, 200))
+
+    #retries failed writes with exponential backoff, until BULK_CREATE_MAX_ATTEMPTS
+    def onWriteError(failure, bulkWriter) -> bool:
+        shouldRetry = failure.attempts < BULK_CREATE_MAX_ATTEMPTS
+        if(not shouldRetry):
+            print(f"An error occurred while bulk creating connection {failure.operation.reference.id} : {failure.message}")
+            resultQueue.put((failure.operation.reference.id, 500))
+        return shouldRetry
+
+    bulkWriter = db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=BULK_CREATE_INITIAL_OPS_PER_SECOND,
+        max_ops_per_second=BULK_CREATE_MAX_OPS_PER_SECOND,
+        retry=BulkRetry.exponential,
+    ))
+    bulkWriter.on_write_result(onWriteResult)
+    bulkWriter.on_write_error(onWriteError)
+
+    indexById = {}#listings written but whose result is not known yet
+
+    #gets results that are known. If wait is True, waits for all written listings
+    def drainResults(wait:bool):
+        while(len(indexById) > 0):
+            try:
+                listingId, status = resultQueue.get(timeout=FIRESTORE_QUERY_TIMEOUT) if wait else resultQueue.get_nowait()
+            except queue.Empty:
+                if(not wait):
+                    return
+                #no answer from firestore in time, so the remaining ones are reported as failed
+                for listingId, index in list(indexById.items()):
+                    yield resultLine(index, 500)
+                indexById.clear()
+                return
+
+            index = indexById.pop(listingId)
+            yield resultLine(index, status, listingId if status == 200 else None)
+
+    def resultLine(index:int, status:int, listingId:str|None = None) -> str:
+        result = {'index': index, 'status': status}
+        if(listingId != None):
+            result['listingId'] = listingId
+        return json.dumps(result) + '\n'
+
+    try:
+        index = -1
+        try:
+            for index, record in enumerate(records):
+                listingDocument = None if type(record) is not dict else buildListingDocument(record, authorId)
+                if(listingDocument == None):
+                    yield resultLine(index, 400)
+                    continue
+
+                listingRef = unapprovedListingsRef.document()#auto ID
+                indexById[listingRef.id] = index
+                bulkWriter.create(listingRef, listingDocument)
+
+                if(len(indexById) >= BULK_CREATE_FLUSH_SIZE):
+                    bulkWriter.flush()
+                    yield from drainResults(wait=True)
+                else:
+                    yield from drainResults(wait=False)
+        except ValueError as e:
+            #upload is not valid JSON from here on, nothing after this can be read
+            print(f"Malformed upload while creating connections: {e}")
+            yield resultLine(index + 1, 400)
+
+        bulkWriter.flush()#writes the remaining listings
+        yield from drainResults(wait=True)
+    finally:
+        bulkWriter.close()#stops the BulkWriter threads, also if the client disconnected in the middle
+
+'''
+description: reads listings one by one from a request body with one JSON per line [NDJSON]
+takes stream: request body stream
+returns generator of dict|None, None for a line that is not valid JSON
+'''
+def iterateNdjsonRecords(stream):
+    for line in stream:
+        line = line.strip()
+        if(len(line) == 0):
+            continue
+
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None#bad line, lines after it can still be read
+
+'''
+description: reads listings one by one from a request body with a JSON array, reading only small chunks of the body at a time
+takes stream: request body stream
+returns generator of the elements of the array
+raises ValueError if the body is not a valid JSON array
+'''
+def iterateJsonArrayRecords(stream):
+    decoder = json.JSONDecoder()
+    utf8Decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    isStreamDone = False
+
+    #reads more of the body into buffer. Returns False if there was nothing more to read
+    def readMore() -> bool:
+        nonlocal buffer, position, isStreamDone
+        if(isStreamDone):
+            return False
+
+        chunk = stream.read(JSON_UPLOAD_CHUNK_SIZE)
+        isStreamDone = (len(chunk) == 0)
+        buffer = buffer[position:] + utf8Decoder.decode(chunk, final=isStreamDone)
+        position = 0
+        return not isStreamDone or len(buffer) > 0
+
+    #skips whitespace, and returns the next character without consuming it, or None at the end of the body
+    def peek() -> str|None:
+        nonlocal position
+        while(True):
+            while(position < len(buffer) and buffer[position].isspace()):
+                position += 1
+            if(position < len(buffer)):
+                return buffer[position]
+            if(not readMore()):
+                return None
+
+    #checks that a character can come right after a complete element
+    def isElementEnd(character:str) -> bool:
+        return character in ',]' or character.isspace()
+
+    if(peek() != '['):
+        raise ValueError('Expected a JSON array')
+    position += 1
+
+    isFirst = True
+    while(True):
+        character = peek()
+        if(character == ']'):
+            return
+        if(character == None):
+            raise ValueError('JSON array is not closed')
+
+        if(not isFirst):
+            if(character != ','):
+                raise ValueError('Expected , between elements of JSON array')
+            position += 1
+            peek()#skip whitespace after ,
+        isFirst = False
+
+        #decode the next element, reading more of the body until it is complete
+        while(True):
+            try:
+                element, endPosition = decoder.raw_decode(buffer, position)
+                if(isStreamDone or (endPosition < len(buffer) and isElementEnd(buffer[endPosition]))):
+                    position = endPosition
+                    break
+                #element is not followed by , or ] in what was read so far. Might be cut off [e.g. 1.5 read as 1 when cut at .], so read more and decode again
+                readMore()
+            except json.JSONDecodeError:
+                if(isStreamDone or not readMore()):
+                    raise ValueError('Malformed element in JSON array')
+
+        yield element
+
+'''
+description: common part of approve-connections and reject-connections api endpoints
+takes approve:bool, True to approve the listings, False to reject them
+returns JSON as described by those endpoints
+'''
+def handleBulkModeration(approve:bool):
+    action = 'approving' if approve else 'rejecting'
+    listingIds = None
+
+    try:
+        if(not checkIfHasAdminAccess()):
+            #the person is not an admin and doesn't have access to this action.
+            return unauthorizedDict
+
+        #ids can come either as JSON body or as form data
+        requestJson = request.get_json(silent=True)
+        if(type(requestJson) is dict):
+            listingIds = requestJson.get('listingIds')
+        else:
+            listingIds = request.form.getlist('listingIds')
+
+        #ids that are not valid listing ids get their own 400 in data, the other ids are still moderated
+        if(type(listingIds) is not list or len(listingIds) == 0 or len(listingIds) > MAX_BULK_MODERATION_SIZE or not all(type(listingId) is str for listingId in listingIds)):
+            return incompleteDict
+
+        result = {
+            'status': 200,
+            'data': moveUnapprovedListings(listingIds, approve)
+        }
+
+        return result
+    except Exception as e:
+        #unknown error handled by error handler declared before
+        print(f"An error occurred while {action} connections with ids {listingIds} : {e}")
+        raise Exception(e)
+
+'''
+description: approves or rejects unapproved listings using as few firestore calls as possible
+- all listings are read with one get_all call
+- approving a listing [copy to approved collection + delete from unapproved collection] is in the same batched write, so it is atomic
+- batched writes have a limit of writes, so listings are committed in chunks
+- a listing is only deleted if it didn't change since it was read, so two admins moderating the same listing at once can't both succeed.
+  If a chunk fails because of that, its listings are tried one by one, so only the changed ones fail
+takes
+    listingIds:list[str] ids of unapproved listings
+    approve:bool, True moves the listings to approved collection, False just deletes them
+returns list of dict with 'listingId':str and 'status':int for each listing id, in the same order.
+    200 if done, 400 if not a valid listing id, 404 if not found, 409 if it changed while moderating [e.g. moderated by someone else], 500 if writing failed
+'''
+def moveUnapprovedListings(listingIds:list, approve:bool) -> list:
+    uniqueListingIds = list(dict.fromkeys(listingIds))#remove duplicates, keep order
+
+    #an id firestore can't make a document reference of [e.g. with /] would fail reading all the others, so it is left out of the read
+    statusById = {}
+    validListingIds = []
+    for listingId in uniqueListingIds:
+        if(isValidListingId(listingId)):
+            validListingIds.append(listingId)
+        else:
+            statusById[listingId] = 400
+
+    #one call for reading all the listings
+    unapprovedDocuments = {}
+    if(len(validListingIds) > 0):
+        for doc in instrumentFirestoreStream(db.get_all([unapprovedListingsRef.document(listingId) for listingId in validListingIds]), 'unapproved', 'get_all'):
+            if(doc.exists):
+                unapprovedDocuments[doc.id] = doc
+
+    foundIds = []
+    for listingId in validListingIds:
+        if(listingId in unapprovedDocuments):
+            foundIds.append(listingId)
+        else:
+            statusById[listingId] = 404#not waiting for approval, maybe already approved or rejected
+
+    for start in range(0, len(foundIds), MODERATION_BATCH_SIZE):
+        chunkIds = foundIds[start:start + MODERATION_BATCH_SIZE]
+
+        try:
+            commitModeration([unapprovedDocuments[listingId] for listingId in chunkIds], approve)
+            chunkStatus = 200
+        except FailedPrecondition as e:
+            #some listing changed after it was read, the whole chunk was not written. Try each listing on its own, so only the changed ones fail
+            print(f"Listings changed while moderating listings {chunkIds}, moderating them one by one : {e}")
+            for listingId in chunkIds:
+                try:
+                    commitModeration([unapprovedDocuments[listingId]], approve)
+                    statusById[listingId] = 200
+                except FailedPrecondition:
+                    statusById[listingId] = 409
+                except Exception as e:
+                    print(f"An error occurred while committing moderation of listing {listingId} : {e}")
+                    statusById[listingId] = 500
+            continue
+        except Exception as e:
+            print(f"An error occurred while committing moderation of listings {chunkIds} : {e}")
+            chunkStatus = 500
+
+        for listingId in chunkIds:
+            statusById[listingId] = chunkStatus
+
+    return [{'listingId': listingId, 'status': statusById[listingId]} for listingId in listingIds]
+
+'''
+description: checks that an id can be the id of a firestore document, so looking it up can't fail the call it is part of
+- firestore document ids can't be empty, contain /, be . or .., look like __name__ or be longer than 1500 bytes
+takes listingId:str
+returns bool
+'''
+def isValidListingId(listingId:str) -> bool:
+    if(listingId in ('', '.', '..') or '/' in listingId):
+        return False
+    if(listingId.startswith('__') and listingId.endswith('__')):
+        return False#reserved by firestore
+    return len(listingId.encode('utf-8')) <= MAX_DOCUMENT_ID_BYTES
+
+'''
+description: approves or rejects unapproved listings in one batched write, so it is all or nothing
+- each listing is only deleted if it was not changed or deleted since it was read, otherwise nothing is written
+takes
+    docs:list of document snapshots of unapproved listings, at most MODERATION_BATCH_SIZE
+    approve:bool, True moves the listings to approved collection, False just deletes them
+returns nothing
+raises FailedPrecondition if any listing changed since it was read
+'''
+def commitModeration(docs:list, approve:bool):
+    tombstoneExpireAt = datetime.now(timezone.utc) + timedelta(days=TOMBSTONE_RETENTION_DAYS)
+
+    batch = db.batch()
+    for doc in docs:
+        listingDocument = doc.to_dict()
+        if(approve):
+            #set instead of create, so retrying after a failure doesn't fail because the approved listing already exists
+            listingDocument['updatedAt'] = firestore.SERVER_TIMESTAMP#approval time, for syncing only changes
+            listingDocument['keywords'] = buildSearchKeywords(listingDocument)#also adds keywords to listings created before search existed
+            batch.set(approvedListingsRef.document(doc.id), listingDocument)
+        batch.delete(unapprovedListingsRef.document(doc.id), option=db.write_option(last_update_time=doc.update_time))
+
+        #remember that the listing is gone from unapproved collection, so frontends syncing only changes remove it
+        batch.set(listingTombstonesRef.document(f'unapproved-{doc.id}'), {
+            'listingId': doc.id,
+            'approved': False,
+            'authorId': listingDocument.get('authorId'),
+            'removedAt': firestore.SERVER_TIMESTAMP,
+            'expireAt': tombstoneExpireAt,#deleted by firestore TTL policy after this, so tombstones don't pile up forever
+        })
+
+    with timeFirestoreOperation('moderation', 'batch_commit'):
+        batch.commit()
+    recordFirestoreWrites(len(docs) * (3 if approve else 2))
+
+'''
+description: callback for mutating a document dictionary fields with desirable information, for documents from unapproved collection
+takes:deserialized dictionary of document and the original serialized document from firestore
+returns:modified doc in dictionary format
+'''
+def changeFieldParamsForUnverfiedDocs(doc, modifiedDoc):
+    modifiedDoc.pop('keywords', None)#only used for searching, not needed by frontend
+    modifiedDoc['id'] = doc.id#listingId
+    modifiedDoc['approved'] = False#as this was fetched from unapprovedCollection. Requires approval by admin
+
+    return modifiedDoc
+
+'''
+description: callback for mutating a document dictionary fields with desirable information, for documents from approved collection
+takes:deserialized dictionary of document and the original serialized document from firestore
+returns:modified doc in dictionary format
+'''
+def changeFieldParamsForVerifiedDocs(doc, modifiedDoc):
+    modifiedDoc.pop('keywords', None)#only used for searching, not needed by frontend
+    modifiedDoc['id'] = doc.id #listingId
+    modifiedDoc['approved'] = True #as this was fetched from approvedCollection. Approved by admin already
+
+    return modifiedDoc
+
+'''
+description: reads all listings of a source
+takes source:dict, source of listings as used by getConnections
+returns list[dict] listings
+'''
+def readSourceListings(source):
+    return convertDocumentsIntoResponseList(streamSourceDocuments(source), source['changeFieldParams'], source.get('fields'))
+
+'''
+description: gets only the listings that were created, approved or removed after a watermark
+- created and approved listings are stamped with updatedAt, removed listings leave a tombstone with removedAt, so both can be queried by time
+- the new watermark is the time before any query started [see watermarkBeforeReading], so nothing is missed next time.
+  Not the latest write time seen, as queries run at slightly different moments and a write between them would be missed for good
+takes
+    sources:list of dict, sources of listings as used by getConnections
+    since:datetime watermark of the previous call, at most TOMBSTONE_RETENTION_DAYS old
+    isAdmin:bool, if False only the user's own removed listings are read [all tombstones are of unapproved listings, which only their author has]
+returns JSON response as described by getConnections
+'''
+def getChangedListings(sources, since:datetime, isAdmin:bool):
+    changeSources = []
+    for source in sources:
+        changeSource = {key: value for key, value in source.items() if key != 'snapshots'}#the in-memory copy can't be queried by time
+        changeSource['query'] = source['query'].where('updatedAt', '>', since)
+        changeSources.append(changeSource)
+    tombstoneQuery = listingTombstonesRef if isAdmin else listingTombstonesRef.where('authorId', '==', g.uid)
+    tombstoneSource = {'name': 'tombstones', 'query': tombstoneQuery.where('removedAt', '>', since)}
+
+    watermark = laterOf(since, watermarkBeforeReading())#never goes back, even if this server's clock is behind the one that gave out since
+    results = fetchFromSourcesConcurrently(changeSources + [tombstoneSource], lambda source: list(streamSourceDocuments(source)))
+
+    changedListings = []
+    for source, docs in zip(changeSources, results[:-1]):
+        changedListings += convertDocumentsIntoResponseList(docs, source['changeFieldParams'], source.get('fields'))
+
+    removedListings = []
+    for doc in results[-1]:
+        tombstone = doc.to_dict()
+        removedListings.append({
+            'id': tombstone['listingId'],
+            'approved': tombstone['approved']
+        })
+
+    #success result
+    result = {
+        'status': 200,
+        'data': changedListings,
+        'removed': removedListings,
+        'watermark': encodeWatermark(watermark)
+    }
+
+    return result
+
+'''
+description: gets the watermark for listings that are about to be read. Called before any query starts
+- every write up to this time was committed before the queries started, so all of them see it, whichever moment each query reads at.
+  Writes after it have a later updatedAt/removedAt, so they come with the next since. Some of them may be sent twice, which is harmless
+- set back by WATERMARK_CLOCK_MARGIN, as updatedAt/removedAt are stamped by firestore's clock, not this server's
+takes nothing
+returns datetime
+'''
+def watermarkBeforeReading() -> datetime:
+    return datetime.now(timezone.utc) - timedelta(seconds=WATERMARK_CLOCK_MARGIN)
+
+'''
+description: checks whether changes since a watermark can still be synced, i.e., the tombstones of listings removed after it haven't expired
+takes since:datetime
+returns bool
+'''
+def isWatermarkTooOld(since:datetime) -> bool:
+    return since < datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+
+'''
+description: converts a time into an opaque string that can be sent to frontend as watermark
+takes watermark:datetime|None, None if nothing was read
+returns str microseconds since epoch
+'''
+def encodeWatermark(watermark:datetime|None) -> str:
+    if(watermark == None):
+        return '0'
+    return str((watermark - EPOCH) // timedelta(microseconds=1))
+
+'''
+description: reverse of encodeWatermark
+takes watermark:str
+returns datetime
+raises ValueError if the watermark is not one that was given out by encodeWatermark
+'''
+def decodeWatermark(watermark:str) -> datetime:
+    microseconds = int(watermark)
+    if(microseconds < 0):
+        raise ValueError('Negative watermark')
+
+    try:
+        return EPOCH + timedelta(microseconds=microseconds)
+    except OverflowError:
+        raise ValueError('Watermark too far in the future')
+
+'''
+description: gets the later of two times, either of which can be missing
+takes first:datetime|None, second:datetime|None
+returns datetime|None
+'''
+def laterOf(first:datetime|None, second:datetime|None) -> datetime|None:
+    if(first == None):
+        return second
+    if(second == None):
+        return first
+    return max(first, second)
+
+'''
+description: creates a streamed response of all listings of the sources, compressed as negotiated from Accept-Encoding header
+takes
+    sources:list of dict, sources of listings as used by getConnections
+    isNdjson:bool, True for one listing per line, False for the same JSON as the not streamed response
+returns flask Response
+'''
+def createStreamedListingsResponse(sources, isNdjson:bool) -> Response:
+    contentEncoding = None
+    acceptEncodings = request.accept_encodings
+    if(brotli != None and acceptEncodings['br'] > 0):
+        contentEncoding = 'br'
+    elif(acceptEncodings['gzip'] > 0):
+        contentEncoding = 'gzip'
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if(contentEncoding != None):
+        headers['Content-Encoding'] = contentEncoding
+
+    chunks = compressStreamChunks(generateStreamedListings(sources, isNdjson), contentEncoding)
+    mimetype = 'application/x-ndjson' if isNdjson else 'application/json'
+
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+'''
+description: reads listings of the sources one by one and yields them already encoded as JSON
+- status can't be changed after streaming started, so if reading fails in the middle, the error is printed and raised again, so the server aborts the
+  connection instead of ending the response cleanly. JSON is left cut off [invalid], NDJSON ends with a {"status":500} line, so a short result can't be taken for a complete one
+takes
+    sources:list of dict, sources of listings as used by getConnections
+    isNdjson:bool, True for one listing per line, False for {'status': 200, 'data': [listings]}
+returns generator of bytes
+'''
+def generateStreamedListings(sources, isNdjson:bool):
+    if(not isNdjson):
+        yield b'{"status":200,"data":['
+
+    isFirst = True
+    try:
+        for source in sources:
+            for doc in streamSourceDocuments(source):
+                encodedListing = encodeJson(source['changeFieldParams'](doc, documentToDict(doc, source.get('fields'))))
+
+                if(isNdjson):
+                    yield encodedListing + b'\n'
+                else:
+                    yield encodedListing if isFirst else b',' + encodedListing
+                isFirst = False
+    except Exception as e:
+        print(f"An error occurred while streaming connections: {e}")
+        if(isNdjson):
+            yield encodeJson(errorDict) + b'\n'
+        raise
+
+    if(not isNdjson):
+        yield b']}'
+
+'''
+description: groups small chunks into bigger ones of STREAM_CHUNK_SIZE, and compresses them
+- if the chunks fail, what was already given is still sent, but the compressed stream is not finished and the error is raised again,
+  so the frontend can't mistake the cut off response for a complete one
+takes
+    chunks:iterable of bytes
+    contentEncoding:str|None 'br', 'gzip' or None for no compression
+returns generator of bytes
+'''
+def compressStreamChunks(chunks, contentEncoding:str|None):
+    compressor = None
+    if(contentEncoding == 'br'):
+        compressor = brotli.Compressor()
+    elif(contentEncoding == 'gzip'):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)#31 means gzip header
+
+    #compresses what is in the pending chunks, and everything before it, so the frontend can already decode it
+    def compressPending(pending:list) -> bytes:
+        data = b''.join(pending)
+        if(compressor == None):
+            return data
+        if(contentEncoding == 'br'):
+            return compressor.process(data) + compressor.flush()
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    pending = []
+    pendingSize = 0
+    try:
+        for chunk in chunks:
+            pending.append(chunk)
+            pendingSize += len(chunk)
+
+            if(pendingSize >= STREAM_CHUNK_SIZE):
+                yield compressPending(pending)
+                pending = []
+                pendingSize = 0
+    except Exception:
+        yield compressPending(pending)#e.g. the error line of NDJSON, flushed without finishing the compressed stream
+        raise
+
+    lastChunk = compressPending(pending)
+    if(compressor != None):
+        lastChunk += compressor.finish() if contentEncoding == 'br' else compressor.flush()
+    if(len(lastChunk) > 0):
+        yield lastChunk
+
+'''
+description: encodes a value into JSON, using orjson if it is installed as it is much faster, otherwise flask's own encoder
+takes value: anything that flask can return as JSON
+returns bytes of JSON
+'''
+def encodeJson(value) -> bytes:
+    if(orjson != None):
+        return orjson.dumps(value, default=app.json.default, option=orjson.OPT_PASSTHROUGH_DATETIME)#dates go to flask too, so they look the same either way
+    return app.json.dumps(value, separators=(',', ':')).encode()#no spaces, smaller response
+
+'''
+description: gets one page of listings from multiple sources [collections/queries], merged in a stable order
+- every source is ordered by document id, and the sources are merged by document id, so pages never skip or repeat listings
+- the cursor remembers the last document id given out from each source, so each source resumes using start_after
+takes
+    sources:list of dict with 'name':str, 'query': firestore query/collection [or 'snapshots'] and 'changeFieldParams': callback for each document
+    limit:int, max number of listings in the page
+    positions:dict of source name -> last document id given out from that source, as decoded from the cursor
+returns tuple of (list[dict] listings of this page, str|None cursor for next page or None if there are no more listings)
+'''
+def fetchListingsPage(sources, limit:int, positions:dict):
+    candidates = []
+
+    #one extra document tells whether there are more listings after this page
+    sourceDocs = fetchFromSourcesConcurrently(sources, lambda source: list(streamSourceDocuments(source, positions.get(source['name']), limit + 1)))
+    for source, docs in zip(sources, sourceDocs):
+        for doc in docs:
+            candidates.append((doc.id, source['name'], doc))
+
+    #merge all sources by document id
+    candidates.sort(key=lambda candidate: (candidate[0], candidate[1]))
+    pageCandidates = candidates[:limit]
+
+    sourcesByName = {source['name']: source for source in sources}
+    nextPositions = dict(positions)
+    pageListings = []
+    for docId, sourceName, doc in pageCandidates:
+        source = sourcesByName[sourceName]
+        pageListings.append(source['changeFieldParams'](doc, documentToDict(doc, source.get('fields'))))
+        nextPositions[sourceName] = docId
+
+    nextCursor = None
+    if(len(candidates) > limit):
+        nextCursor = encodePageCursor(nextPositions)
+
+    return pageListings, nextCursor
+
+'''
+description: runs a fetch for every source of listings at the same time, instead of one after the other
+takes
+    sources:list of dict, sources of listings as used by getConnections [or any other queries to run at the same time]
+    fetch:callback that takes a source and returns whatever was read from it. Runs in a shared thread, so it shouldn't use the request context
+    executor:ThreadPoolExecutor threads to run the fetches on. Defaults to the ones shared by getConnections calls
+returns list of results of fetch, in the same order as sources
+raises concurrent.futures.TimeoutError if any source takes longer than FIRESTORE_QUERY_TIMEOUT, including the time waiting for a free thread
+'''
+def fetchFromSourcesConcurrently(sources, fetch:Callable, executor:ThreadPoolExecutor|None = None) -> list:
+    executor = executor or firestoreQueryExecutor
+
+    #each fetch runs in a copy of the request's context variables, so its firestore reads are counted for this request
+    futures = [executor.submit(contextvars.copy_context().run, fetch, source) for source in sources]
+
+    try:
+        deadline = time.monotonic() + FIRESTORE_QUERY_TIMEOUT
+        return [future.result(timeout=max(0, deadline - time.monotonic())) for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()#nothing left to wait for if one failed. Already running ones can't be cancelled, but are bounded by the query timeout
+
+'''
+description: gets documents of a source of listings, either from firestore or from the in-memory snapshots the source carries
+takes
+    source:dict with 'query': firestore query/collection, optionally 'snapshots': list of document snapshots sorted by id to use instead of firestore,
+           optionally 'fields': list of field names to read, and optionally 'conditions': list of (fieldName, '==' or 'array_contains', value) filters
+    afterId:str|None, only documents with id after this are returned. Only needed for pagination
+    count:int|None, max number of documents to return. Only needed for pagination
+returns iterable of document snapshots
+'''
+def streamSourceDocuments(source, afterId:str|None = None, count:int|None = None):
+    paginate = (afterId != None or count != None)
+    conditions = source.get('conditions', [])
+
+    if('snapshots' in source):
+        snapshots = source['snapshots']
+        if(not paginate and len(conditions) == 0):
+            return snapshots
+
+        #snapshots are already sorted by id, so binary search for where to resume
+        startIndex = 0
+        if(afterId != None):
+            startIndex = bisect.bisect_right(snapshots, afterId, key=lambda doc: doc.id)
+        matchingSnapshots = (doc for doc in itertools.islice(snapshots, startIndex, None) if documentMatchesConditions(doc, conditions))
+        return list(itertools.islice(matchingSnapshots, count))
+
+    query = source['query']
+
+    #firestore allows only one array_contains per query, the other ones are checked after reading
+    remainingConditions = []
+    hasArrayContains = False
+    for fieldName, operator, value in conditions:
+        if(operator == 'array_contains' and hasArrayContains):
+            remainingConditions.append((fieldName, operator, value))
+            continue
+        hasArrayContains = hasArrayContains or (operator == 'array_contains')
+        query = query.where(fieldName, operator, value)
+
+    if(source.get('fields') != None):
+        #only read these fields from database, and the ones needed for checking remaining conditions
+        selectedFields = list(dict.fromkeys(source['fields'] + [condition[0] for condition in remainingConditions]))
+        query = query.select(selectedFields)
+    if(paginate):
+        query = query.order_by(DOCUMENT_ID_FIELD)
+
+    if(len(remainingConditions) > 0):
+        return instrumentFirestoreStream(streamDocumentsMatchingConditions(query, remainingConditions, afterId, count), source['name'], 'query')
+
+    if(paginate):
+        if(afterId != None):
+            query = query.start_after({DOCUMENT_ID_FIELD: afterId})#resume right after the last listing given out from this source
+        if(count != None):
+            query = query.limit(count)
+
+    return instrumentFirestoreStream(query.stream(timeout=FIRESTORE_QUERY_TIMEOUT), source['name'], 'query')
+
+'''
+description: reads documents of a query and keeps only those matching conditions that firestore couldn't check itself
+- when paginating, reads page after page from firestore until enough matching documents are found, so pages are never cut short
+takes
+    query:firestore query, ordered by document id if paginating
+    conditions:list of (fieldName, operator, value) conditions to check
+    afterId:str|None, only documents with id after this are returned
+    count:int|None, max number of matching documents to return. None reads everything in one go
+returns generator of document snapshots
+'''
+def streamDocumentsMatchingConditions(query, conditions:list, afterId:str|None, count:int|None):
+    if(count == None):
+        pageQuery = query if afterId == None else query.start_after({DOCUMENT_ID_FIELD: afterId})
+        for doc in pageQuery.stream(timeout=FIRESTORE_QUERY_TIMEOUT):
+            if(documentMatchesConditions(doc, conditions)):
+                yield doc
+        return
+
+    matchedCount = 0
+    while(True):
+        pageQuery = query if afterId == None else query.start_after({DOCUMENT_ID_FIELD: afterId})
+        docs = list(pageQuery.limit(count).stream(timeout=FIRESTORE_QUERY_TIMEOUT))
+
+        for doc in docs:
+            afterId = doc.id
+            if(documentMatchesConditions(doc, conditions)):
+                yield doc
+                matchedCount += 1
+                if(matchedCount == count):
+                    return
+
+        if(len(docs) < count):
+            return#no more documents
+
+'''
+description: checks a document against filter conditions in memory, the same way firestore would
+takes
+    doc:document snapshot
+    conditions:list of (fieldName, '==' or 'array_contains', value)
+returns True if the document matches all conditions
+'''
+def documentMatchesConditions(doc, conditions:list) -> bool:
+    for fieldName, operator, value in conditions:
+        try:
+            fieldValue = doc.get(fieldName)
+        except KeyError:
+            return False#field not in document
+
+        if(operator == '==' and fieldValue != value):
+            return False
+        if(operator == 'array_contains' and (type(fieldValue) is not list or value not in fieldValue)):
+            return False
+
+    return True
+
+'''
+description: converts the position of each source into an opaque string that can be sent to frontend
+takes positions:dict of source name -> last document id given out from that source
+returns cursor:str
+'''
+def encodePageCursor(positions:dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+'''
+description: reverse of encodePageCursor
+takes cursor:str
+returns positions:dict of source name -> last document id given out from that source, and the watermark of the pagination
+raises ValueError if the cursor is not one that was given out by encodePageCursor
+'''
+def decodePageCursor(cursor:str) -> dict:
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f'Malformed cursor: {e}')
+
+    if(type(positions) is not dict or not all(type(key) is str and type(value) is str for key, value in positions.items())):
+        raise ValueError('Malformed cursor')
+
+    #a position firestore can't make a document reference of [e.g. with /] would fail the query with a 500 instead
+    if(not all(key == PAGE_WATERMARK_KEY or isValidListingId(value) for key, value in positions.items())):
+        raise ValueError('Malformed cursor position')
+
+    return positions
+
+'''
+description: deserializes a document, keeping only some of its fields if asked
+- documents read from firestore with select() only have those fields already, but documents of the in-memory copy have all fields
+takes
+    doc:document fetched from firestore
+    fields:list[str]|None names of fields to keep, None keeps all fields
+returns dict of the document
+'''
+def documentToDict(doc, fields:list|None = None) -> dict:
+    docDict = doc.to_dict()#convert to dictionary
+    if(fields == None):
+        return docDict
+
+    return {fieldName: docDict[fieldName] for fieldName in fields if fieldName in docDict}
+
+'''
+description: goes over each document and deserializes it. Also, helps do a callback over each document
+takes 
+    docs:list of documents fetched from firestore collection
+    changeFieldParams:callback that should return a modified doc, and is given deserialized dictionary of document and the original serialized document
+    fields:list[str]|None names of fields to keep in each document, None keeps all fields
+returns all modified document in form of list[dict]
+'''
+def convertDocumentsIntoResponseList(docs, changeFieldParams, fields:list|None = None):
+    allListings = []
+
+    #go over all docs
+    for doc in docs:
+        modifiedDoc = documentToDict(doc, fields)#convert to dictionary
+        modifiedDoc = changeFieldParams(doc, modifiedDoc)#helps carry any changes to each document
+        
+        allListings.append(modifiedDoc)
+    
+    return allListings
+
+'''
+description: checks if the user is an admin or not
+takes nothing
+returns True if user is admin or False if the user is not
+'''
+def checkIfHasAdminAccess() -> bool:
+    return (g.uid == ADMIN_TOKEN)
+
+'''
+description: checks if the token is valid or not
+takes token:str
+returns userId:str extracted from the token
+'''
+def verifyIfTokenIsValid(tokenId:str) -> str|None:
+    tokenKey = hashlib.sha256(tokenId.encode()).hexdigest()
+
+    #token was verified recently, no need to verify it again
+    cachedUid = getCachedTokenUid(tokenKey)
+    if(cachedUid != None):
+        return cachedUid
+
+    with tokenCache['lock']:
+        isRevocationCheck = tokenKey in tokenCache['entries']#cached, but has to be checked for revocation again
+        if(isRevocationCheck):
+            tokenCache['revocationChecks'] += 1
+        else:
+            tokenCache['misses'] += 1
+
+    try:
+        decodedToken = firebase_auth.verify_id_token(tokenId, check_revoked=(TOKEN_REVOCATION_CHECK_INTERVAL > 0))
+    except Exception:
+        #token is fake, expired or revoked. Make sure it is not served from cache anymore
+        removeCachedToken(tokenKey)
+        raise
+
+    cacheVerifiedToken(tokenKey, decodedToken)
+    return decodedToken['uid']
+
+#shared session for calling google identity toolkit api. requests sessions can be shared by threads
+identityToolkitSession = createIdentityToolkitSession()
+
+#state of the circuit breaker of identity toolkit api
+identityToolkitCircuit = {
+    'lock': threading.Lock(),
+    'failures': 0,#failures in a row
+    'openUntil': 0.0,#time.monotonic() until which calls fail right away
+}
+
+#cache of listing stats, by breakdowns asked for. Least recently counted first
+listingStatsCache = {
+    'lock': threading.Lock(),
+    'entries': OrderedDict(),#(locations, authorIds) -> {'stats', 'countedAt'}
+}
+
+#threads for running firestore queries of getConnections at the same time
+firestoreQueryExecutor = ThreadPoolExecutor(max_workers=FIRESTORE_QUERY_THREADS, thread_name_prefix='firestore-query')
+#separate, fewer threads for the count queries of connection stats
+statsQueryExecutor = ThreadPoolExecutor(max_workers=STATS_QUERY_THREADS, thread_name_prefix='stats-query')
+
+#************IN-MEMORY VIEW OF APPROVED LISTINGS*************
+#approved listings only change when an admin approves a listing, so instead of reading the whole collection on every get-connections call,
+#an optional in-memory copy is kept up to date by a firestore snapshot listener.
+
+'''
+description: callback of the snapshot listener on approved listings collection. Replaces the in-memory copy with the latest snapshot
+- the first snapshot of a listener has all documents, later ones are only billed for the documents that changed
+takes docSnapshots: all documents in the collection, changes: what changed since last snapshot, readTime: time of the snapshot
+returns nothing
+'''
+def onApprovedListingsSnapshot(docSnapshots, changes, readTime):
+    try:
+        recordFirestoreReads(len(changes), 'approvedView')
+        replaceApprovedListingsView(docSnapshots, readTime)
+    except Exception as e:
+        #errors can't be raised back to the listener thread, so ask the refresher thread to reload everything
+        print(f'Exception occurred in approved listings snapshot listener: {e}')
+        approvedListingsView['reloadRequested'].set()
+
+'''
+description: replaces the in-memory copy of approved listings and marks it as synced with the current listener and ready
+takes
+    docSnapshots: iterable of all documents in the approved listings collection
+    readTime: datetime|None time in database the documents are from, None if not known
+returns nothing
+'''
+def replaceApprovedListingsView(docSnapshots, readTime:datetime|None = None):
+    snapshots = sorted(docSnapshots, key=lambda doc: doc.id)#sorted by id, same order as firestore uses for pagination
+
+    with approvedListingsView['lock']:
+        approvedListingsView['snapshots'] = snapshots
+        approvedListingsView['readTime'] = readTime
+        approvedListingsView['synced'] = True
+        approvedListingsView['confirmedAt'] = time.monotonic()
+
+    approvedListingsView['ready'].set()
+
+'''
+description: (re)starts the snapshot listener. Its first snapshot has the whole collection and fills the in-memory copy, so the collection isn't read separately
+- until that first snapshot arrives, the copy is not used and firestore is read instead
+takes nothing
+returns nothing
+'''
+def reloadApprovedListingsView():
+    if(not ensureServicesInitialized()):
+        raise RuntimeError('firebase services are not available')
+
+    with approvedListingsView['lock']:
+        approvedListingsView['synced'] = False
+        approvedListingsView['confirmedAt'] = time.monotonic()#gives the new listener until the staleness bound to send its first snapshot
+
+    stopApprovedListingsWatch()#old listener might have died, make sure it is stopped before starting a new one
+
+    watch = approvedListingsRef.on_snapshot(onApprovedListingsSnapshot)
+    with approvedListingsView['lock']:
+        approvedListingsView['watch'] = watch
+
+'''
+description: runs forever in a background thread. Restarts the snapshot listener only when it has closed [e.g. failed for good], or when its callback failed
+- a listener that is alive keeps the copy up to date even if the collection is quiet for a long time, so it is not restarted just because time passed
+- a listener that fails doesn't call back, so whether it is still alive is checked every few seconds. Checking costs no reads
+- a listener can also stay alive but stop sending updates, so once in a while the copy is probed [see probeApprovedListingsView].
+  If it isn't confirmed up to date within APPROVED_LISTINGS_VIEW_MAX_STALENESS, the listener is restarted
+takes nothing
+returns nothing
+'''
+def refreshApprovedListingsViewForever():
+    while True:
+        if(not isApprovedListingsWatchAlive() or isApprovedListingsViewOutdated()):
+            try:
+                reloadApprovedListingsView()
+            except Exception as e:
+                print(f'Exception occurred while reloading approved listings view: {e}')
+        elif(time.monotonic() - approvedListingsView['probedAt'] >= APPROVED_LISTINGS_VIEW_PROBE_INTERVAL):
+            approvedListingsView['probedAt'] = time.monotonic()
+            probeApprovedListingsView()
+
+        #wait until either the listener callback asks for a reload, or it is time to check the listener again
+        if(approvedListingsView['reloadRequested'].wait(APPROVED_LISTINGS_VIEW_CHECK_INTERVAL)):
+            approvedListingsView['reloadRequested'].clear()
+            stopApprovedListingsWatch()#copy might have missed a change, so it isn't used until the listener is restarted
+
+'''
+description: checks that the in-memory copy is up to date, by reading only the newest approved listing's name and write time [1 read],
+and confirms the copy if it has that listing, written at the same time or later
+- approved listings are never deleted, so if the copy has the newest write, it has all of them, and its read time moves up to the probe's
+- a listing the copy doesn't have yet doesn't mean much by itself, the listener might just be about to send it. Only no confirmation for a long time does
+takes nothing
+returns nothing
+'''
+def probeApprovedListingsView():
+    probedAt = watermarkBeforeReading()#the probe reads at this time or later
+    try:
+        with timeFirestoreOperation('approvedView', 'probe'):
+            newestDocs = approvedListingsRef.select([]).order_by('updatedAt', direction=firestore.Query.DESCENDING).limit(1).get(timeout=FIRESTORE_QUERY_TIMEOUT)
+        recordFirestoreReads(1, 'approvedView')#a query is billed at least one read, even if nothing is found
+    except Exception as e:
+        print(f'Exception occurred while probing approved listings view: {e}')
+        return
+
+    with approvedListingsView['lock']:
+        snapshots = approvedListingsView['snapshots']
+        isConfirmed = approvedListingsView['synced']
+        for newestDoc in newestDocs:
+            index = bisect.bisect_left(snapshots, newestDoc.id, key=lambda doc: doc.id)
+            isConfirmed = isConfirmed and index < len(snapshots) and snapshots[index].id == newestDoc.id and snapshots[index].update_time >= newestDoc.update_time
+
+        if(isConfirmed):
+            approvedListingsView['confirmedAt'] = time.monotonic()
+            #copy is complete up to the probe too. The listener only calls back when something changed, so on a quiet collection
+            #its read time would stay at the last approval, and watermarks given out from the copy would become too old to sync from
+            approvedListingsView['readTime'] = laterOf(approvedListingsView['readTime'], probedAt)
+
+'''
+description: checks if the in-memory copy went without being confirmed up to date for too long, e.g. the listener is alive but stuck
+takes nothing
+returns True if the copy is outdated
+'''
+def isApprovedListingsViewOutdated() -> bool:
+    with approvedListingsView['lock']:
+        confirmedAt = approvedListingsView['confirmedAt']
+
+    return confirmedAt == None or (time.monotonic() - confirmedAt) > APPROVED_LISTINGS_VIEW_MAX_STALENESS
+
+'''
+description: checks if the snapshot listener of approved listings is running
+takes nothing
+returns True if the listener is running
+'''
+def isApprovedListingsWatchAlive() -> bool:
+    with approvedListingsView['lock']:
+        watch = approvedListingsView['watch']
+
+    return watch != None and watch.is_active
+
+'''
+description: stops the snapshot listener of approved listings, if there is one, so the refresher thread starts a new one
+takes nothing
+returns nothing
+'''
+def stopApprovedListingsWatch():
+    with approvedListingsView['lock']:
+        watch = approvedListingsView['watch']
+        approvedListingsView['watch'] = None
+
+    if(watch != None):
+        try:
+            watch.unsubscribe()
+        except Exception as e:
+            print(f'Exception occurred while stopping approved listings snapshot listener: {e}')
+
+'''
+description: starts keeping the in-memory copy of approved listings, if it is turned on in .env. Does nothing if it was already started
+takes nothing
+returns nothing
+'''
+def startApprovedListingsView():
+    if(not APPROVED_LISTINGS_VIEW_ENABLED):
+        return
+
+    with approvedListingsView['lock']:
+        if(approvedListingsView['started']):
+            return
+        approvedListingsView['started'] = True
+
+    threading.Thread(target=refreshApprovedListingsViewForever, name='approved-listings-view', daemon=True).start()
+
+'''
+description: checks if the in-memory copy of approved listings can be used to answer requests, i.e., it is turned on, ready,
+kept up to date by a listener that is still alive, and was confirmed up to date recently
+takes nothing
+returns True if the copy can be used
+'''
+def isApprovedListingsViewUsable() -> bool:
+    if(not APPROVED_LISTINGS_VIEW_ENABLED or not approvedListingsView['ready'].is_set()):
+        return False
+
+    with approvedListingsView['lock']:
+        synced = approvedListingsView['synced']
+
+    return synced and isApprovedListingsWatchAlive() and not isApprovedListingsViewOutdated()
+
+'''
+description: gets the in-memory copy of approved listings
+takes nothing
+returns tuple of (list of document snapshots sorted by id, datetime|None read time of the copy), or None if the copy can't be used and firestore should be read instead
+'''
+def getApprovedListingsViewSnapshots():
+    if(not isApprovedListingsViewUsable()):
+        return None
+
+    with approvedListingsView['lock']:
+        return approvedListingsView['snapshots'], approvedListingsView['readTime']
+
+#state of the in-memory copy. Snapshots list is replaced as a whole [never mutated], so readers can use it without holding the lock
+approvedListingsView = {
+    'lock': threading.Lock(),
+    'ready': threading.Event(),#set once the first full copy was loaded
+    'reloadRequested': threading.Event(),
+    'started': False,
+    'watch': None,
+    'snapshots': [],
+    'readTime': None,#time in database the snapshots are from, as told by the listener
+    'synced': False,#True once the current listener sent its first snapshot, so the copy is up to date
+    'confirmedAt': None,#time.monotonic() of the last listener update or probe that showed the copy is up to date
+    'probedAt': 0.0,#time.monotonic() of the last probe
+}
+
+#************CACHE OF VERIFIED AUTH TOKENS*************
+#verifying a token means checking its signature and claims. Same token is sent with every call of a user, so the verified result is cached
+#until the token expires. Tokens are stored by their hash, so the cache never keeps the tokens themselves.
+
+'''
+description: gets the user id of a token from the cache of verified tokens
+takes tokenKey:str hash of the token
+returns userId:str, or None if the token is not cached, expired, or has to be checked for revocation again
+'''
+def getCachedTokenUid(tokenKey:str) -> str|None:
+    now = time.time()
+
+    with tokenCache['lock']:
+        entry = tokenCache['entries'].get(tokenKey)
+        if(entry == None):
+            return None
+
+        if(entry['expiresAt'] <= now):
+            #token expired, user needs to login again
+            del tokenCache['entries'][tokenKey]
+            return None
+
+        if(TOKEN_REVOCATION_CHECK_INTERVAL > 0 and (now - entry['checkedAt']) >= TOKEN_REVOCATION_CHECK_INTERVAL):
+            #time to check again that the token was not revoked
+            return None
+
+        tokenCache['entries'].move_to_end(tokenKey)#most recently used
+        tokenCache['hits'] += 1
+        return entry['uid']
+
+'''
+description: adds a verified token to the cache. Removes the least recently used tokens if the cache is full
+takes tokenKey:str hash of the token, decodedToken:dict claims of the verified token
+returns nothing
+'''
+def cacheVerifiedToken(tokenKey:str, decodedToken:dict):
+    with tokenCache['lock']:
+        tokenCache['entries'][tokenKey] = {
+            'uid': decodedToken['uid'],
+            'expiresAt': decodedToken['exp'],#token's own expiry time, in seconds since epoch
+            'checkedAt': time.time(),
+        }
+        tokenCache['entries'].move_to_end(tokenKey)
+
+        while(len(tokenCache['entries']) > TOKEN_CACHE_MAX_SIZE):
+            tokenCache['entries'].popitem(last=False)
+
+'''
+description: removes a token from the cache, e.g. when it was found to be revoked
+takes tokenKey:str hash of the token
+returns nothing
+'''
+def removeCachedToken(tokenKey:str):
+    with tokenCache['lock']:
+        tokenCache['entries'].pop(tokenKey, None)
+
+'''
+description: fetches google's public certificates used for verifying auth tokens, so that the first user's call doesn't have to wait for them
+- verifies a token that has everything verifying checks before fetching the certificates, but no valid signature. Verifying fetches and caches
+  the certificates, then fails with InvalidIdTokenError, which is expected. Only the public api of the sdk is used
+takes nothing
+returns nothing
+'''
+def warmUpSigningCertificates():
+    try:
+        projectId = get_app().project_id
+    except ValueError:
+        projectId = None#no firebase app, e.g. stand-ins are configured. Verifying fails before fetching anything
+
+    try:
+        firebase_auth.verify_id_token(buildWarmUpIdToken(projectId))
+    except auth.InvalidIdTokenError:
+        pass#certificates were fetched, only the signature didn't match
+    except Exception as e:
+        print(f'Exception occurred while warming up token signing certificates: {e}')
+
+'''
+description: builds an unsigned auth token of the project, for warming up token verification
+takes projectId:str|None firebase project id
+returns token:str
+'''
+def buildWarmUpIdToken(projectId:str|None) -> str:
+    def encodeSegment(value) -> str:
+        data = value if type(value) is bytes else json.dumps(value).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+    header = {'alg': 'RS256', 'kid': 'warm-up', 'typ': 'JWT'}
+    payload = {'aud': projectId, 'iss': f'https://securetoken.google.com/{projectId}', 'sub': 'warm-up'}
+    return '.'.join([encodeSegment(header), encodeSegment(payload), encodeSegment(b'warm-up')])
+
+#state of the token cache. Stats are only for monitoring how well the cache works
+tokenCache = {
+    'lock': threading.Lock(),
+    'entries': OrderedDict(),#hash of token -> {'uid', 'expiresAt', 'checkedAt'}, least recently used first
+    'hits': 0,
+    'misses': 0,
+    'revocationChecks': 0,
+}
+
+#************METRICS*************
+#latency histograms and counters, kept in memory and sent in prometheus text format by the metrics api.
+#each worker process has its own metrics, so monitoring should read every worker [or use one worker with many threads].
+
+'''
+description: wraps every api endpoint and middleware, to record the status it returns and the time auth takes
+- most APIs return their status inside the JSON body [e.g. incompleteDict], not as http status, so it is read from what they return
+takes nothing
+returns nothing
+'''
+def instrumentRoutes():
+    for endpoint, viewFunction in list(app.view_functions.items()):
+        if(not getattr(viewFunction, 'isInstrumented', False)):
+            app.view_functions[endpoint] = instrumentView(viewFunction)
+
+    beforeRequestFunctions = app.before_request_funcs.setdefault(None, [])
+    for index, function in enumerate(beforeRequestFunctions):
+        if(function is verifyTokenMiddleware):
+            beforeRequestFunctions[index] = instrumentView(function, isAuth=True)
+        elif(function is initializeServicesMiddleware):
+            beforeRequestFunctions[index] = instrumentView(function)#records 503 while firebase can't be started
+
+'''
+description: wraps a view function or middleware, recording the status it returns
+takes
+    viewFunction:callable to wrap
+    isAuth:bool, True for the token verification middleware, whose time is recorded separately
+returns wrapped callable
+'''
+def instrumentView(viewFunction:Callable, isAuth:bool = False) -> Callable:
+    @functools.wraps(viewFunction)
+    def instrumentedView(*args, **kwargs):
+        startedAt = time.perf_counter()
+        try:
+            result = viewFunction(*args, **kwargs)
+        except Exception:
+            g.resultStatus = 500
+            raise
+        finally:
+            if(isAuth):
+                authSeconds = time.perf_counter() - startedAt
+                g.requestMetrics['authSeconds'] = authSeconds
+                observeHistogram('auth_verification_duration_seconds', (), authSeconds)
+
+        if(result != None):
+            g.resultStatus = statusOfResult(result)
+        return result
+
+    instrumentedView.isInstrumented = True
+    return instrumentedView
+
+'''
+description: finds the status of what an api endpoint returned
+takes result: dict with 'status', flask Response, or anything else flask accepts
+returns status:int
+'''
+def statusOfResult(result) -> int:
+    if(type(result) is dict and type(result.get('status')) is int):
+        return result['status']
+    if(isinstance(result, Response)):
+        if(result.is_json and not result.is_streamed):
+            body = result.get_json(silent=True)
+            if(type(body) is dict and type(body.get('status')) is int):
+                return body['status']
+        return result.status_code
+    return 200
+
+'''
+description: wraps documents read from firestore, counting them and timing how long reading all of them took
+takes
+    docs:iterable of document snapshots, usually a firestore stream
+    sourceName:str name of what was read, e.g. 'approved'
+    operation:str kind of read, e.g. 'query'
+returns generator of the same documents
+'''
+def instrumentFirestoreStream(docs, sourceName:str, operation:str):
+    startedAt = time.perf_counter()
+    readCount = 0
+    isError = False
+
+    try:
+        for doc in docs:
+            readCount += 1
+            yield doc
+    except Exception:
+        isError = True
+        raise
+    finally:
+        labels = (('source', sourceName), ('operation', operation))
+        observeHistogram('firestore_operation_duration_seconds', labels, time.perf_counter() - startedAt)
+        if(isError):
+            incrementCounter('firestore_operation_errors_total', labels)
+        recordFirestoreReads(readCount, sourceName)
+
+'''
+description: times a firestore operation that is not a read, e.g. committing a batch
+takes
+    sourceName:str name of what was written, e.g. 'moderation'
+    operation:str kind of operation, e.g. 'batch_commit'
+returns context manager
+'''
+@contextlib.contextmanager
+def timeFirestoreOperation(sourceName:str, operation:str):
+    startedAt = time.perf_counter()
+    labels = (('source', sourceName), ('operation', operation))
+    try:
+        yield
+    except Exception:
+        incrementCounter('firestore_operation_errors_total', labels)
+        raise
+    finally:
+        observeHistogram('firestore_operation_duration_seconds', labels, time.perf_counter() - startedAt)
+
+'''
+description: counts documents read from firestore, in total and for the current request
+takes count:int number of documents, sourceName:str name of what was read
+returns nothing
+'''
+def recordFirestoreReads(count:int, sourceName:str):
+    incrementCounter('firestore_documents_read_total', (('source', sourceName),), count)
+
+    requestMetrics = requestMetricsVar.get(None)
+    if(requestMetrics != None):
+        with metrics['lock']:
+            requestMetrics['firestoreReads'] += count
+
+'''
+description: counts documents written to firestore, in total and for the current request
+takes
+    count:int number of documents
+    requestMetrics:dict|None metrics of the request that wrote them, for threads that don't have the request's context [e.g. BulkWriter callbacks]. Defaults to the current request
+returns nothing
+'''
+def recordFirestoreWrites(count:int, requestMetrics:dict|None = None):
+    incrementCounter('firestore_documents_written_total', (), count)
+
+    requestMetrics = requestMetrics or requestMetricsVar.get(None)
+    if(requestMetrics != None):
+        with metrics['lock']:
+            requestMetrics['firestoreWrites'] += count
+
+'''
+description: adds to a counter metric
+takes name:str metric name, labels:tuple of (labelName, value) pairs, amount:int|float to add
+returns nothing
+'''
+def incrementCounter(name:str, labels:tuple, amount:int|float = 1):
+    with metrics['lock']:
+        counter = metrics['counters'].setdefault(name, {})
+        counter[labels] = counter.get(labels, 0) + amount
+
+'''
+description: records a value in a histogram metric
+takes name:str metric name, labels:tuple of (labelName, value) pairs, value:int|float, buckets:tuple of upper bounds of buckets
+returns nothing
+'''
+def observeHistogram(name:str, labels:tuple, value:int|float, buckets:tuple = LATENCY_BUCKETS):
+    with metrics['lock']:
+        histogram = metrics['histograms'].setdefault(name, {'buckets': buckets, 'series': {}})
+        series = histogram['series'].get(labels)
+        if(series == None):
+            series = {'bucketCounts': [0] * len(histogram['buckets']), 'sum': 0, 'count': 0}
+            histogram['series'][labels] = series
+
+        bucketIndex = bisect.bisect_left(histogram['buckets'], value)#first bucket with upper bound >= value
+        if(bucketIndex < len(histogram['buckets'])):
+            series['bucketCounts'][bucketIndex] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+'''
+description: renders all metrics in prometheus text format
+takes nothing
+returns str
+'''
+def renderMetrics() -> str:
+    #values owned by other parts of the backend
+    with tokenCache['lock']:
+        tokenCacheValues = (('hits', tokenCache['hits']), ('misses', tokenCache['misses']), ('revocation_checks', tokenCache['revocationChecks']))
+        tokenCacheSize = len(tokenCache['entries'])
+
+    lines = []
+    with metrics['lock']:
+        for name, counter in sorted(metrics['counters'].items()):
+            lines.append(f'# HELP {name} {METRIC_DESCRIPTIONS.get(name, name)}')
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in sorted(counter.items()):
+                lines.append(f'{name}{formatMetricLabels(labels)} {value}')
+
+        for name, histogram in sorted(metrics['histograms'].items()):
+            lines.append(f'# HELP {name} {METRIC_DESCRIPTIONS.get(name, name)}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, series in sorted(histogram['series'].items()):
+                cumulativeCount = 0
+                for upperBound, bucketCount in zip(histogram['buckets'], series['bucketCounts']):
+                    cumulativeCount += bucketCount
+                    lines.append(f'{name}_bucket{formatMetricLabels(labels + (("le", str(upperBound)),))} {cumulativeCount}')
+                lines.append(f'{name}_bucket{formatMetricLabels(labels + (("le", "+Inf"),))} {series["count"]}')
+                lines.append(f'{name}_sum{formatMetricLabels(labels)} {series["sum"]}')
+                lines.append(f'{name}_count{formatMetricLabels(labels)} {series["count"]}')
+
+    lines.append('# HELP token_cache_requests_total Auth token verifications by result of looking up the cache')
+    lines.append('# TYPE token_cache_requests_total counter')
+    for result, value in tokenCacheValues:
+        lines.append(f'token_cache_requests_total{{result="{result}"}} {value}')
+    lines.append('# HELP token_cache_entries Verified auth tokens in the cache')
+    lines.append('# TYPE token_cache_entries gauge')
+    lines.append(f'token_cache_entries {tokenCacheSize}')
+
+    lines.append('# HELP approved_listings_view_usable 1 if approved listings are answered from the in-memory copy')
+    lines.append('# TYPE approved_listings_view_usable gauge')
+    lines.append(f'approved_listings_view_usable {1 if isApprovedListingsViewUsable() else 0}')
+
+    lines.append('# HELP startup_duration_seconds Time taken by each phase of starting up this worker process')
+    lines.append('# TYPE startup_duration_seconds gauge')
+    for phase, seconds in sorted(startupTimings.copy().items()):#copied, as the warm-up thread might still be adding timings
+        lines.append(f'startup_duration_seconds{{phase="{phase}"}} {seconds}')
+
+    return '\n'.join(lines) + '\n'
+
+'''
+description: formats labels of a metric in prometheus text format, e.g. {endpoint="login",status="200"}
+takes labels:tuple of (labelName, value) pairs
+returns str, empty if there are no labels
+'''
+def formatMetricLabels(labels:tuple) -> str:
+    if(len(labels) == 0):
+        return ''
+
+    formattedLabels = []
+    for labelName, value in labels:
+        escapedValue = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formattedLabels.append(f'{labelName}="{escapedValue}"')
+    return '{' + ','.join(formattedLabels) + '}'
+
+#descriptions of metrics, shown in the metrics api
+METRIC_DESCRIPTIONS = {
+    'http_requests_total': 'API calls by endpoint and status returned',
+    'http_request_duration_seconds': 'Time taken by API calls, not including sending streamed bodies',
+    'auth_verification_duration_seconds': 'Time taken by auth token verification middleware',
+    'firestore_documents_read_per_request': 'Firestore documents read by an API call',
+    'firestore_documents_written_per_request': 'Firestore documents written by an API call',
+    'firestore_documents_read_total': 'Firestore documents read',
+    'firestore_documents_written_total': 'Firestore documents written',
+    'firestore_operation_duration_seconds': 'Time taken by Firestore operations, for reads until all documents are read',
+    'firestore_operation_errors_total': 'Firestore operations that failed',
+}
+
+#state of metrics. Counters and histograms are dicts of labels tuple -> value
+metrics = {
+    'lock': threading.Lock(),
+    'counters': {},
+    'histograms': {},
+}
+
+#firestore reads and writes of the current request. Copied into threads that run firestore queries for the request
+requestMetricsVar = contextvars.ContextVar('requestMetrics')
+
+instrumentRoutes()
+
+#************STARTUP*************
+#firebase is not created on import. It is created by the first API call that needs it, or earlier by the warm-up thread started by createApp,
+#so a new server [e.g. cold start of a serverless host] can answer health checks right away, and main.py can be imported without credentials.
+
+'''
+description: app factory. Entry point for serving the app, e.g. by gunicorn [see gunicorn.conf.py] or flask --app "main:createApp()"
+- starts the background work [warming up firebase and connections, in-memory view of approved listings] once per process. 
+  Should be called after the server forks its worker processes, as background threads don't survive a fork
+takes nothing
+returns the flask app
+'''
+def createApp() -> Flask:
+    with startupLock:
+        if(not startupState['started']):
+            startupState['started'] = True
+
+            threading.Thread(target=warmUpServices, name='services-warm-up', daemon=True).start()
+            startApprovedListingsView()
+
+    return app
+
+'''
+description: runs in a background thread after startup. Creates firebase services and opens connections before the first user's call needs them,
+then prints how long starting up took
+- fetches token signing certificates, opens the channel to firestore with a tiny query, and connects to the login api
+- failures are only printed, the first API call that needs a service tries again
+takes nothing
+returns nothing
+'''
+def warmUpServices():
+    startedAt = time.perf_counter()
+    try:
+        if(ensureServicesInitialized()):
+            warmUpSigningCertificates()
+            warmUpFirestoreChannel()
+            if(signInWithPassword is signInWithIdentityToolkit):
+                warmUpIdentityToolkitConnection()
+    finally:
+        startupTimings['warmUpSeconds'] = time.perf_counter() - startedAt
+        startupTimings['readySeconds'] = time.perf_counter() - startedImportingAt
+        print(json.dumps({'event': 'startup', **{name: round(seconds, 3) for name, seconds in startupTimings.items()}}))
+
+'''
+description: opens the channel to firestore by reading the name of at most one approved listing, so the first user's query doesn't have to connect
+takes nothing
+returns nothing
+'''
+def warmUpFirestoreChannel():
+    try:
+        with timeFirestoreOperation('warmUp', 'query'):
+            docs = approvedListingsRef.select([]).limit(1).get(timeout=FIRESTORE_QUERY_TIMEOUT)
+        recordFirestoreReads(max(len(docs), 1), 'warmUp')#a query is billed at least one read, even if nothing is found
+    except Exception as e:
+        print(f'Exception occurred while warming up firestore channel: {e}')
+
+'''
+description: connects to the login api, so the connection is kept alive in the shared session and the first login doesn't have to connect
+- the api answers the request with an error, which doesn't matter. Only the connection is needed
+takes nothing
+returns nothing
+'''
+def warmUpIdentityToolkitConnection():
+    try:
+        identityToolkitSession.head(IDENTITY_TOOLKIT_URL, timeout=(IDENTITY_TOOLKIT_CONNECT_TIMEOUT, IDENTITY_TOOLKIT_READ_TIMEOUT))
+    except requests.RequestException as e:
+        print(f'Exception occurred while warming up identity toolkit connection: {e}')
+
+startupLock = threading.Lock()
+startupState = {
+    'started': False
+}
+
+#state of firebase services. configured is set once by configureServices
+servicesState = {
+    'lock': threading.Lock(),
+    'configured': False,
+}
+
+#seconds taken by each phase of starting up. Sent by metrics api
+startupTimings = {
+    'importSeconds': time.perf_counter() - startedImportingAt,
+}
@@ -0,0 +1,153 @@
+'''
+Description:
+- Checks that create-connections reads uploads the same way wherever the body is cut into chunks, and reports a result for every listing.
+
+Run using: python -m pytest -q test_bulkCreate.py [or python -m unittest test_bulkCreate]
+'''
+import io
+import json
+import unittest
+from unittest import mock
+
+import fakeFirebase
+import main
+
+AUTHOR_UID = 'bulk-create-author'
+
+#elements that are easy to read wrongly when cut, e.g. a number cut at its . or exponent, or a character of several bytes
+TRICKY_ELEMENTS = [1.5, {'a': 1}, -2e10, 'café ☕', [1, [2, 3]], True, None, 0, {'b': '] , ['}, 123456789]
+
+'''
+description: body stream which gives at most chunkSize bytes per read, like a request body arriving in small pieces
+'''
+class ChunkedStream(io.RawIOBase):
+    def __init__(self, body:bytes, chunkSize:int):
+        self.body = body
+        self.chunkSize = chunkSize
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self.body[self.position:self.position + min(self.chunkSize, len(buffer))]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+'''
+description: builds a listing as uploaded by frontend
+takes index:int
+returns dict
+'''
+def buildListing(index:int) -> dict:
+    return {
+        'title': f'Bulk listing {index}',
+        'description': 'Listing created by the bulk create test ☕',
+        'type': 'facebook',
+        'link': f'https://facebook.com/groups/{index}',
+        'location': 'Toronto',
+    }
+
+class JsonArrayParserTest(unittest.TestCase):
+    def readWithChunkSize(self, body:bytes, chunkSize:int) -> list:
+        with mock.patch.object(main, 'JSON_UPLOAD_CHUNK_SIZE', chunkSize):
+            return list(main.iterateJsonArrayRecords(ChunkedStream(body, chunkSize)))
+
+    def testSameResultForEveryChunkSize(self):
+        for body in (json.dumps(TRICKY_ELEMENTS).encode('utf-8'), b' [ 1.5 ,\n{"a":1} , {"b":2}\t]  ', b'[]', b'[1e5]', b'[-0.25E-3,2]'):
+            expected = json.loads(body)
+            for chunkSize in range(1, len(body) + 2):
+                self.assertEqual(self.readWithChunkSize(body, chunkSize), expected, f'chunk size {chunkSize} of {body}')
+
+    def testMalformedBodies(self):
+        for body in (b'', b'{"a":1}', b'[1,2', b'[1 2]', b'[1,]', b'[{"a":}]', b'[1.5x]', b'[tru]'):
+            for chunkSize in (1, 2, 3, 64):
+                with self.assertRaises(ValueError, msg=f'chunk size {chunkSize} of {body}'):
+                    self.readWithChunkSize(body, chunkSize)
+
+    def testElementsBeforeMalformedPartAreRead(self):
+        body = b'[{"a":1}, 2.5, oops]'
+        for chunkSize in (1, 3, 64):
+            with mock.patch.object(main, 'JSON_UPLOAD_CHUNK_SIZE', chunkSize):
+                records = main.iterateJsonArrayRecords(ChunkedStream(body, chunkSize))
+                self.assertEqual(next(records), {'a': 1})
+                self.assertEqual(next(records), 2.5)
+                with self.assertRaises(ValueError):
+                    next(records)
+
+class NdjsonParserTest(unittest.TestCase):
+    def testSameResultForEveryChunkSize(self):
+        body = ('\n'.join(json.dumps(element) for element in TRICKY_ELEMENTS) + '\n\n{bad json}\n  \n{"last": 2.5}').encode('utf-8')
+        expected = TRICKY_ELEMENTS + [None, {'last': 2.5}]
+
+        for chunkSize in range(1, len(body) + 2):
+            stream = io.BufferedReader(ChunkedStream(body, chunkSize), buffer_size=chunkSize)
+            self.assertEqual(list(main.iterateNdjsonRecords(stream)), expected, f'chunk size {chunkSize}')
+
+class CreateConnectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.firestoreClient, _ = fakeFirebase.useFakeServices()
+
+        self.client = main.app.test_client()
+        self.headers = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(AUTHOR_UID)}'}
+
+    '''
+    description: uploads listings and reads the result lines
+    takes body:bytes, contentType:str
+    returns list of dict results, ordered by index
+    '''
+    def upload(self, body:bytes, contentType:str) -> list:
+        response = self.client.post('/create-connections', data=body, content_type=contentType, headers=self.headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        return sorted(results, key=lambda result: result['index'])
+
+    def getUnapprovedListings(self) -> list:
+        return self.firestoreClient.collection('UnapprovedListings').get()
+
+    def testStatusOfEachListing(self):
+        incomplete = buildListing(1)
+        del incomplete['location']
+        notText = dict(buildListing(3), title=1.5)
+        records = [buildListing(0), incomplete, 'not a listing', notText, buildListing(4)]
+
+        for contentType, body in (('application/json', json.dumps(records)), ('application/x-ndjson', '\n'.join(json.dumps(record) for record in records) + '\n{bad json')):
+            with self.subTest(contentType=contentType):
+                with mock.patch.object(main, 'JSON_UPLOAD_CHUNK_SIZE', 7):
+                    results = self.upload(body.encode('utf-8'), contentType)
+                expectedStatuses = [200, 400, 400, 400, 200] + ([400] if contentType == 'application/x-ndjson' else [])
+
+                self.assertEqual([result['index'] for result in results], list(range(len(expectedStatuses))))
+                self.assertEqual([result['status'] for result in results], expectedStatuses)
+                for result in results:
+                    self.assertEqual('listingId' in result, result['status'] == 200)
+
+        listings = self.getUnapprovedListings()
+        self.assertEqual(len(listings), 4)
+        for listing in listings:
+            self.assertEqual(listing.get('authorId'), AUTHOR_UID)
+            self.assertIn(listing.get('title'), ('Bulk listing 0', 'Bulk listing 4'))
+
+    def testMalformedArrayKeepsListingsBeforeIt(self):
+        body = (json.dumps([buildListing(0), buildListing(1)])[:-1] + ', {"title": ').encode('utf-8')
+
+        for chunkSize in (1, 5, 64 * 1024):
+            with mock.patch.object(main, 'JSON_UPLOAD_CHUNK_SIZE', chunkSize):
+                results = self.upload(body, 'application/json')
+            self.assertEqual([(result['index'], result['status']) for result in results], [(0, 200), (1, 200), (2, 400)], f'chunk size {chunkSize}')
+
+    def testNotAnArray(self):
+        results = self.upload(json.dumps(buildListing(0)).encode('utf-8'), 'application/json')
+
+        self.assertEqual(results, [{'index': 0, 'status': 400}])
+        self.assertEqual(self.getUnapprovedListings(), [])
+
+    def testUnsupportedContentType(self):
+        response = self.client.post('/create-connections', data=b'title=x', content_type='text/plain', headers=self.headers)
+
+        self.assertEqual(response.get_json()['status'], 400)
+
+if __name__ == '__main__':
+    unittest.main()
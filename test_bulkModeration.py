@@ -0,0 +1,81 @@
+'''
+Description:
+- Checks that approve-connections and reject-connections give each listing id its own result, so one bad id doesn't fail the others.
+
+Run using: python -m pytest -q test_bulkModeration.py [or python -m unittest test_bulkModeration]
+'''
+import unittest
+from unittest import mock
+
+import fakeFirebase
+import main
+
+ADMIN_UID = 'moderation-admin'
+AUTHOR_UID = 'moderation-author'
+
+@mock.patch.object(main, 'ADMIN_TOKEN', ADMIN_UID)
+class BulkModerationTest(unittest.TestCase):
+    def setUp(self):
+        self.firestoreClient, _ = fakeFirebase.useFakeServices()
+
+        self.client = main.app.test_client()
+        self.adminHeaders = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(ADMIN_UID)}'}
+
+    '''
+    description: creates unapproved listings as a user
+    takes count:int
+    returns list[str] ids of the listings
+    '''
+    def createListings(self, count:int) -> list:
+        headers = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(AUTHOR_UID)}'}
+        for index in range(count):
+            form = {
+                'title': f'Listing {index}',
+                'description': 'Listing created by the moderation test',
+                'type': 'whatsapp',
+                'link': f'https://chat.whatsapp.com/{index}',
+                'location': 'Toronto',
+            }
+            self.assertEqual(self.client.post('/create-connection', data=form, headers=headers).get_json()['status'], 200)
+
+        return [listing['id'] for listing in self.client.get('/get-connections?unapproved=true', headers=self.adminHeaders).get_json()['data']]
+
+    def getListingsById(self) -> dict:
+        listings = self.client.get('/get-connections?unapproved=true', headers=self.adminHeaders).get_json()['data']
+        return {listing['id']: listing for listing in listings}
+
+    def testInvalidIdsFailOnlyThemselves(self):
+        listingIds = self.createListings(2)
+        invalidIds = ['a/b', '', '..', '__reserved__', 'x' * (main.MAX_DOCUMENT_ID_BYTES + 1)]
+
+        response = self.client.post('/approve-connections', json={'listingIds': invalidIds + listingIds + ['missing']}, headers=self.adminHeaders).get_json()
+
+        self.assertEqual(response['status'], 200)
+        statuses = [result['status'] for result in response['data']]
+        self.assertEqual(statuses, [400] * len(invalidIds) + [200, 200, 404])
+
+        listingsById = self.getListingsById()
+        for listingId in listingIds:
+            self.assertTrue(listingsById[listingId]['approved'])
+
+    def testOnlyInvalidIds(self):
+        response = self.client.post('/reject-connections', json={'listingIds': ['a/b/c']}, headers=self.adminHeaders).get_json()
+
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(response['data'], [{'listingId': 'a/b/c', 'status': 400}])
+
+    def testRejectRemovesListings(self):
+        listingIds = self.createListings(3)
+
+        response = self.client.post('/reject-connections', json={'listingIds': listingIds + listingIds[:1]}, headers=self.adminHeaders).get_json()
+
+        self.assertEqual([result['status'] for result in response['data']], [200, 200, 200, 200])
+        self.assertEqual(self.getListingsById(), {})
+
+    def testSingleApproveWithInvalidId(self):
+        response = self.client.post('/approve-connection', data={'listingId': 'a/b'}, headers=self.adminHeaders).get_json()
+
+        self.assertEqual(response['status'], 400)
+
+if __name__ == '__main__':
+    unittest.main()
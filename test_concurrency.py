@@ -0,0 +1,84 @@
+'''
+Description:
+- Checks that the caller's identity stays with its own request when many requests are served at the same time, by different threads.
+
+Run using: python -m pytest -q test_concurrency.py [or python -m unittest test_concurrency]
+'''
+import threading
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+import fakeFirebase
+import main
+
+#users sending requests at the same time, and listings each of them creates
+USER_COUNT = 16
+LISTINGS_PER_USER = 5
+ADMIN_UID = 'concurrency-admin'
+
+@mock.patch.object(main, 'ADMIN_TOKEN', ADMIN_UID)
+class ConcurrentIdentityTest(unittest.TestCase):
+    def setUp(self):
+        fakeFirebase.useFakeServices()
+
+        with main.tokenCache['lock']:
+            main.tokenCache['entries'].clear()
+
+    '''
+    description: each user creates listings and then reads them back, all users at the same time. Every user must see exactly its own unapproved listings,
+    and only the admin may see everyone's unapproved listings
+    '''
+    def testIdentityDoesNotLeakBetweenConcurrentRequests(self):
+        uids = [f'concurrency-user-{index}' for index in range(USER_COUNT)]
+        barrier = threading.Barrier(USER_COUNT + 1)#all users and the admin start at the same time, so their requests overlap
+
+        def actAsUser(uid:str) -> dict:
+            client = main.app.test_client()
+            headers = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(uid)}'}
+            barrier.wait()
+
+            for index in range(LISTINGS_PER_USER):
+                form = {
+                    'title': f'{uid} listing {index}',
+                    'description': 'Listing created by the concurrency test',
+                    'type': 'whatsapp',
+                    'link': f'https://chat.whatsapp.com/{uid}{index}',
+                    'location': 'Toronto',
+                }
+                self.assertEqual(client.post('/create-connection', data=form, headers=headers).get_json()['status'], 200)
+
+            return {
+                'listings': client.get('/get-connections', headers=headers).get_json(),
+                'unapprovedAsUser': client.get('/get-connections?unapproved=true', headers=headers).get_json(),
+            }
+
+        def actAsAdmin() -> list:
+            client = main.app.test_client()
+            headers = {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(ADMIN_UID)}'}
+            barrier.wait()
+
+            statuses = []
+            for _ in range(LISTINGS_PER_USER):
+                statuses.append(client.get('/get-connections?unapproved=true', headers=headers).get_json()['status'])
+            return statuses
+
+        with ThreadPoolExecutor(max_workers=USER_COUNT + 1) as executor:
+            adminFuture = executor.submit(actAsAdmin)
+            userResults = dict(zip(uids, executor.map(actAsUser, uids)))
+
+        self.assertEqual(adminFuture.result(), [200] * LISTINGS_PER_USER)
+
+        for uid, result in userResults.items():
+            self.assertEqual(result['listings']['status'], 200)
+            self.assertEqual(result['unapprovedAsUser']['status'], 403, f'{uid} was treated as admin')
+
+            listings = result['listings']['data']
+            self.assertEqual(len(listings), LISTINGS_PER_USER, f'{uid} sees listings of other users')
+            for listing in listings:
+                self.assertFalse(listing['approved'])
+                self.assertEqual(listing['authorId'], uid)
+                self.assertTrue(listing['title'].startswith(f'{uid} listing'))
+
+if __name__ == '__main__':
+    unittest.main()
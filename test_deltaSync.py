@@ -0,0 +1,122 @@
+'''
+Description:
+- Checks that get-connections with since returns what changed after a watermark, only reads the caller's own removed listings,
+  and asks for a full sync when the watermark is older than removed listings are remembered for. A full sync never gives out a watermark that old,
+  also when approved listings come from an in-memory copy of a quiet collection.
+
+Run using: python -m pytest -q test_deltaSync.py [or python -m unittest test_deltaSync]
+'''
+import time
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+import fakeFirebase
+import main
+
+ADMIN_UID = 'sync-admin'
+AUTHOR_UIDS = ('sync-author-0', 'sync-author-1')
+
+@mock.patch.object(main, 'ADMIN_TOKEN', ADMIN_UID)
+@mock.patch.object(main, 'WATERMARK_CLOCK_MARGIN', 0)#fake firestore stamps writes with this process's clock
+class DeltaSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.firestoreClient, _ = fakeFirebase.useFakeServices()
+
+        self.client = main.app.test_client()
+
+    def headersOf(self, uid:str) -> dict:
+        return {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(uid)}'}
+
+    def createListing(self, uid:str, title:str):
+        form = {
+            'title': title,
+            'description': 'Listing created by the delta sync test',
+            'type': 'whatsapp',
+            'link': 'https://chat.whatsapp.com/sync',
+            'location': 'Toronto',
+        }
+        self.assertEqual(self.client.post('/create-connection', data=form, headers=self.headersOf(uid)).get_json()['status'], 200)
+
+    def listingIdsOf(self, uid:str) -> list:
+        listings = self.client.get('/get-connections', headers=self.headersOf(uid)).get_json()['data']
+        return [listing['id'] for listing in listings]
+
+    def testOnlyOwnRemovedListingsAreRead(self):
+        for uid in AUTHOR_UIDS:
+            self.createListing(uid, f'{uid} listing')
+        watermark = self.client.get('/get-connections', headers=self.headersOf(AUTHOR_UIDS[0])).get_json()['watermark']
+
+        listingIds = {uid: self.listingIdsOf(uid)[0] for uid in AUTHOR_UIDS}
+        response = self.client.post('/reject-connections', json={'listingIds': list(listingIds.values())}, headers=self.headersOf(ADMIN_UID)).get_json()
+        self.assertEqual([result['status'] for result in response['data']], [200, 200])
+
+        response = self.client.get(f'/get-connections?since={watermark}', headers=self.headersOf(AUTHOR_UIDS[0])).get_json()
+        self.assertEqual(response['status'], 200)
+        self.assertEqual(response['removed'], [{'id': listingIds[AUTHOR_UIDS[0]], 'approved': False}])
+
+        response = self.client.get(f'/get-connections?since={watermark}&unapproved=true', headers=self.headersOf(ADMIN_UID)).get_json()
+        self.assertEqual(sorted(removed['id'] for removed in response['removed']), sorted(listingIds.values()))
+
+        for tombstone in self.firestoreClient.collection('ListingTombstones').get():
+            self.assertGreater(tombstone.get('expireAt'), tombstone.get('removedAt') + timedelta(days=main.TOMBSTONE_RETENTION_DAYS - 1))
+
+    def testTooOldWatermarkAsksForResync(self):
+        tooOld = datetime.now(timezone.utc) - timedelta(days=main.TOMBSTONE_RETENTION_DAYS, minutes=1)
+
+        for since in ('0', main.encodeWatermark(tooOld)):
+            response = self.client.get(f'/get-connections?since={since}', headers=self.headersOf(AUTHOR_UIDS[0])).get_json()
+            self.assertEqual(response, {'status': 400, 'resync': True})
+
+    def testLastPageGivesWatermark(self):
+        for index in range(5):
+            self.createListing(AUTHOR_UIDS[0], f'listing {index}')
+
+        headers = self.headersOf(AUTHOR_UIDS[0])
+        response = self.client.get('/get-connections?limit=2', headers=headers).get_json()
+        self.createListing(AUTHOR_UIDS[0], 'listing created while paginating')
+
+        pageCount = 1
+        while(response['nextCursor'] != None):
+            self.assertNotIn('watermark', response)
+            response = self.client.get(f"/get-connections?limit=2&cursor={response['nextCursor']}", headers=headers).get_json()
+            pageCount += 1
+        self.assertEqual(pageCount, 3)
+
+        #the listing created after the first page was read comes again with since, even if a later page already had it
+        response = self.client.get(f"/get-connections?since={response['watermark']}", headers=headers).get_json()
+        self.assertEqual(response['status'], 200)
+        self.assertEqual([listing['title'] for listing in response['data']], ['listing created while paginating'])
+
+    #removed listings remembered for 1 second, so a quiet collection gets older than that without a long wait
+    @mock.patch.object(main, 'TOMBSTONE_RETENTION_DAYS', 1 / (24 * 60 * 60))
+    @mock.patch.object(main, 'APPROVED_LISTINGS_VIEW_ENABLED', True)
+    def testQuietInMemoryCopyGivesUsableWatermark(self):
+        headers = self.headersOf(AUTHOR_UIDS[0])
+        self.createListing(AUTHOR_UIDS[0], 'approved listing')
+        response = self.client.post('/approve-connections', json={'listingIds': self.listingIdsOf(AUTHOR_UIDS[0])}, headers=self.headersOf(ADMIN_UID)).get_json()
+        self.assertEqual(response['data'][0]['status'], 200)
+
+        main.reloadApprovedListingsView()#fake listener sends its first snapshot right away, then only after changes
+        self.addCleanup(main.stopApprovedListingsWatch)
+        self.assertIsNotNone(main.getApprovedListingsViewSnapshots())
+        time.sleep(1.5)
+
+        #copy was not confirmed since the approval, so it is too old to give out a watermark from and firestore is read instead
+        for query in ('', 'limit=5'):
+            response = self.client.get(f'/get-connections?{query}', headers=headers).get_json()
+            self.assertEqual(len(response['data']), 1)
+            response = self.client.get(f"/get-connections?since={response['watermark']}", headers=headers).get_json()
+            self.assertEqual(response['status'], 200, f'watermark of a full sync with {query} was rejected')
+
+        #a probe confirms the copy is still complete, so it is used again with a watermark from the probe's time
+        main.probeApprovedListingsView()
+        self.assertGreater(main.getApprovedListingsViewSnapshots()[1], datetime.now(timezone.utc) - timedelta(seconds=1))
+        with mock.patch.object(main, 'readSourceListings', wraps=main.readSourceListings) as readSourceListings:
+            response = self.client.get('/get-connections', headers=headers).get_json()
+        self.assertTrue(any('snapshots' in call.args[0] for call in readSourceListings.call_args_list))
+        response = self.client.get(f"/get-connections?since={response['watermark']}", headers=headers).get_json()
+        self.assertEqual(response['status'], 200)
+
+if __name__ == '__main__':
+    unittest.main()
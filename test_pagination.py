@@ -0,0 +1,109 @@
+'''
+Description:
+- Checks that paging through get-connections gives every listing exactly once, while the pages merge unapproved and approved listings by id.
+- Paged with every page size, reading approved listings from firestore and from the in-memory copy, and with search that firestore can't fully check.
+
+Run using: python -m pytest -q test_pagination.py [or python -m unittest test_pagination]
+'''
+import base64
+import json
+import unittest
+from unittest import mock
+
+import fakeFirebase
+import main
+
+ADMIN_UID = 'pagination-admin'
+AUTHOR_UIDS = ('pagination-author-0', 'pagination-author-1')
+
+#listings created by each author, every other one is approved. Titles make search match only some of them
+LISTINGS_PER_AUTHOR = 6
+TITLES = ('garden club', 'garden', 'chess club', 'club garden party')
+
+class PaginationTest(unittest.TestCase):
+    def setUp(self):
+        #patched in setUp instead of on the class, as setUp already approves listings as admin
+        adminPatch = mock.patch.object(main, 'ADMIN_TOKEN', ADMIN_UID)
+        adminPatch.start()
+        self.addCleanup(adminPatch.stop)
+
+        fakeFirebase.useFakeServices()
+        self.client = main.app.test_client()
+
+        for uid in AUTHOR_UIDS:
+            for index in range(LISTINGS_PER_AUTHOR):
+                form = {
+                    'title': TITLES[index % len(TITLES)],
+                    'description': f'Listing {index} created by the pagination test',
+                    'type': 'whatsapp',
+                    'link': f'https://chat.whatsapp.com/{uid}{index}',
+                    'location': 'Toronto',
+                }
+                self.assertEqual(self.client.post('/create-connection', data=form, headers=self.headersOf(uid)).get_json()['status'], 200)
+
+        listingIds = [listing['id'] for listing in self.getAllListings(ADMIN_UID, 'unapproved=true')]
+        response = self.client.post('/approve-connections', json={'listingIds': listingIds[::2]}, headers=self.headersOf(ADMIN_UID)).get_json()
+        self.assertEqual({result['status'] for result in response['data']}, {200})
+
+    def headersOf(self, uid:str) -> dict:
+        return {'Authorization': f'Bearer {fakeFirebase.fakeIdToken(uid)}'}
+
+    def getAllListings(self, uid:str, query:str) -> list:
+        response = self.client.get(f'/get-connections?{query}', headers=self.headersOf(uid)).get_json()
+        self.assertEqual(response['status'], 200)
+        return response['data']
+
+    '''
+    description: pages through listings with every page size, checking each one gives the same listings as reading them all at once
+    takes uid:str user paging, query:str query parameters other than limit and cursor
+    returns nothing
+    '''
+    def checkEveryPageSize(self, uid:str, query:str):
+        expectedIds = sorted(listing['id'] for listing in self.getAllListings(uid, query))
+        self.assertTrue(len(expectedIds) > 0)
+
+        for limit in range(1, len(expectedIds) + 2):
+            pagedIds = []
+            cursor = None
+            while(True):
+                cursorParam = '' if cursor == None else f'&cursor={cursor}'
+                response = self.client.get(f'/get-connections?{query}&limit={limit}{cursorParam}', headers=self.headersOf(uid)).get_json()
+                self.assertEqual(response['status'], 200)
+                self.assertLessEqual(len(response['data']), limit)
+
+                pagedIds += [listing['id'] for listing in response['data']]
+                self.assertLessEqual(len(pagedIds), len(expectedIds), f'{query} with limit {limit} gives listings more than once')
+                cursor = response['nextCursor']
+                if(cursor == None):
+                    break
+                self.assertEqual(len(response['data']), limit, 'only the last page can be short')
+
+            self.assertEqual(pagedIds, expectedIds, f'{query} with limit {limit}')
+
+    def checkAllQueries(self):
+        self.checkEveryPageSize(ADMIN_UID, 'unapproved=true')
+        self.checkEveryPageSize(AUTHOR_UIDS[0], 'unapproved=false')
+        #second word is checked after reading, so pages are filled by reading more from firestore
+        self.checkEveryPageSize(ADMIN_UID, 'unapproved=true&search=garden%20club')
+        self.checkEveryPageSize(AUTHOR_UIDS[1], 'search=club%20garden')
+
+    def testPagesFromFirestore(self):
+        self.assertIsNone(main.getApprovedListingsViewSnapshots())
+        self.checkAllQueries()
+
+    @mock.patch.object(main, 'APPROVED_LISTINGS_VIEW_ENABLED', True)
+    def testPagesFromInMemoryCopy(self):
+        main.reloadApprovedListingsView()#fake listener sends its first snapshot right away
+        self.addCleanup(main.stopApprovedListingsWatch)
+        self.assertIsNotNone(main.getApprovedListingsViewSnapshots())
+
+        self.checkAllQueries()
+
+    def testTamperedCursor(self):
+        for positions in ({'approved': 'a/b'}, {'unapproved': ''}, {'approved': 5}, ['approved']):
+            cursor = base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+            response = self.client.get(f'/get-connections?limit=2&cursor={cursor}', headers=self.headersOf(ADMIN_UID)).get_json()
+            self.assertEqual(response['status'], 400, f'cursor {positions}')
+
+if __name__ == '__main__':
+    unittest.main()